@@ -7,7 +7,13 @@
 # https://www.gnu.org/licenses/gpl-3.0.txt)
 
 from ansible.module_utils.basic import *
+import json
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 import requests
+from requests.compat import urlparse
 try:
     import HTMLParser
 except ImportError:
@@ -29,13 +35,89 @@ description:
 options:
     state:
         description:
-            - State of agent
+            - State of agent. drained waits until the replication queue
+              of the agent is empty, it does not change the agent
         required: true
-        choices: [present, absent, enabled, disabled, password]
+        choices: [present, absent, enabled, disabled, password, drained]
     name:
         description:
-            - agent name
-        required: true
+            - agent name, name, agents or dispatchers is required
+        required: false
+    agents:
+        description:
+            - List of agents in folder to reconcile in one task. Every item
+              takes name, state and the agent options of this module, the
+              options not set in an item are taken from the task. The
+              folder is read once with a single request, the agents are
+              compared in memory and only the changed ones are written,
+              concurrently over one keep-alive session
+        required: false
+    dispatchers:
+        description:
+            - List of dispatcher URLs, one flush agent is kept per
+              dispatcher. A URL without path gets /dispatcher/invalidate.cache.
+              The agents are reconciled like with agents
+        required: false
+    name_template:
+        description:
+            - Name of the flush agent of a dispatcher with dispatchers.
+              {dispatcher} is the host name of the dispatcher, {index} its
+              position in dispatchers starting from 1. Prefer {dispatcher},
+              {index} renames agents when a dispatcher is removed from the list
+        required: false
+        default: flush_{dispatcher}
+    delete_stale:
+        description:
+            - Delete the flush agents matching the fixed prefix of
+              name_template that no dispatcher maps to any more, with
+              dispatchers. Agents created by hand with the same prefix are
+              deleted too, name_template must start with a fixed prefix
+        required: false
+        default: false
+        type: bool
+    nodes:
+        description:
+            - List of AEM URLs like http://publ01:4503 to reconcile the
+              flush agents of dispatchers on, concurrently, instead of
+              host and port
+        required: false
+    concurrency:
+        description:
+            - Number of agents written in parallel with agents or
+              dispatchers, per node
+        required: false
+        default: 4
+    verify:
+        description:
+            - Read the agent back after it was written and check the
+              written properties. All changes of an agent, including
+              enabled and the transport password, are sent in one POST
+        required: false
+        default: false
+        type: bool
+    drain_timeout:
+        description:
+            - Seconds to wait for the queue to drain with state drained
+        required: false
+        default: 600
+    poll_interval:
+        description:
+            - Seconds between two reads of the queue with state drained.
+              The interval is doubled up to max_poll_interval while the
+              queue does not shrink and reset when it does
+        required: false
+        default: 1
+    max_poll_interval:
+        description:
+            - Longest interval between two reads of the queue
+        required: false
+        default: 30
+    stuck_timeout:
+        description:
+            - Fail state drained when the same item stays at the head of
+              the queue for this many seconds
+        required: false
+        default: 300
         folder:
         description:
             - Folder containing agents. Usually 'agents.author' or 'agents.publish'.
@@ -149,12 +231,18 @@ options:
         required: true
     host:
         description:
-            - Host name where AEM is running
-        required: true
+            - Host name where AEM is running, host or nodes is required
+        required: false
     port:
         description:
-            - Port number that AEM is listening on
-        required: true
+            - Port number that AEM is listening on, required with host
+        required: false
+    timings_file:
+        description:
+            - Every HTTP call is returned in timings with method, path,
+              status, bytes and latency, and also appended as a JSON line
+              to this file when it is set
+        required: false
 '''
 
 EXAMPLES = '''
@@ -172,44 +260,217 @@ EXAMPLES = '''
     admin_password: admin
     host: auth01
     port: 4502
+
+# Reconcile several agents of a folder in one task
+- aem_agent:
+    state: present
+    folder: 'agents.author'
+    transport_user: admin
+    transport_password: admin
+    agents:
+      - name: publish01
+        transport_uri: 'http://publ01:4503/bin/receive?sling:authRequestLogin=1'
+      - name: publish02
+        transport_uri: 'http://publ02:4503/bin/receive?sling:authRequestLogin=1'
+      - name: publish_old
+        state: absent
+    admin_user: admin
+    admin_password: admin
+    host: auth01
+    port: 4502
+
+# One flush agent per dispatcher on every publisher
+- aem_agent:
+    state: present
+    folder: 'agents.publish'
+    dispatchers:
+      - 'http://disp01:80'
+      - 'http://disp02:80'
+    name_template: 'flush_{dispatcher}'
+    delete_stale: true
+    triggers: 'on_receive,no_versioning'
+    nodes:
+      - 'http://publ01:4503'
+      - 'http://publ02:4503'
+    admin_user: admin
+    admin_password: admin
+  run_once: true
+
+# Wait for the replication queue of an agent to be empty
+- aem_agent:
+    name: publish01
+    state: drained
+    folder: 'agents.author'
+    drain_timeout: 1800
+    stuck_timeout: 600
+    admin_user: admin
+    admin_password: admin
+    host: auth01
+    port: 4502
 '''
 
 
+def _text(value):
+    return '' if value is None else '%s' % value
+
+
+def _flag(value):
+    return _text(value).lower()
+
+
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return ['%s' % v for v in value]
+    return ['%s' % value]
+
+
+# properties of jcr:content kept in line with the agent options:
+# option, property, value of a missing property, normalizer applied to the
+# option and to the property before they are compared
+AGENT_FIELDS = [
+    ('title', 'jcr:title', '', _text),
+    ('description', 'jcr:description', '', _text),
+    ('template', 'template', '', _text),
+    ('transport_uri', 'transportUri', '', _text),
+    ('transport_user', 'transportUser', '', _text),
+    ('retry_delay', 'retryDelay', '', _text),
+    ('serialization_type', 'serializationType', '', _text),
+    ('log_level', 'logLevel', 'info', _text),
+    ('connection_close', 'protocolHTTPConnectionClose', 'false', _flag),
+    ('connect_timeout', 'protocolConnectTimeout', '', _text),
+    ('protocol_version', 'protocolVersion', '', _text),
+    ('agent_user', 'userId', '', _text),
+    ('batch_mode', 'queueBatchMode', '', _flag),
+    ('batch_wait_time', 'queueBatchWaitTime', '', _text),
+    ('batch_max_size', 'queueBatchMaxSize', '', _text),
+]
+FLUSH_HEADERS = ['CQ-Action:{action}', 'CQ-Handle:{path}', 'CQ-Path:{path}']
+FLUSH_PATH = '/dispatcher/invalidate.cache'
+
+# options of an agent that can be set per item of agents
+AGENT_OPTIONS = dict(
+    name=dict(required=True),
+    state=dict(choices=['present', 'absent', 'enabled', 'disabled', 'password', 'drained']),
+    title=dict(),
+    description=dict(),
+    transport_uri=dict(),
+    transport_user=dict(),
+    transport_password=dict(no_log=True),
+    agent_user=dict(),
+    template=dict(),
+    resource_type=dict(),
+    retry_delay=dict(type='int'),
+    triggers=dict(type='list'),
+    log_level=dict(),
+    serialization_type=dict(),
+    headers=dict(),
+    connection_close=dict(type='bool'),
+    connect_timeout=dict(),
+    protocol_version=dict(),
+    batch_mode=dict(type='bool'),
+    batch_wait_time=dict(),
+    batch_max_size=dict(),
+)
+
+
+# --------------------------------------------------------------------------------
+# Timings of HTTP calls.
+# --------------------------------------------------------------------------------
+class _Timings(object):
+    """method, path, status, bytes and latency of every HTTP call of a
+    session, recorded by its response hook"""
+
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def hook(self, response, *args, **kwargs):
+        # runs before the body is read, so bytes_in is the Content-Length
+        # and seconds is the time until the response headers arrived
+        url = urlparse(response.request.url)
+        call = {'method': response.request.method,
+                'path': url.path + ('?' + url.query if url.query else ''),
+                'status': response.status_code,
+                'bytes_out': int(response.request.headers.get(
+                    'Content-Length') or 0),
+                'bytes_in': int(response.headers.get('Content-Length') or 0),
+                'seconds': round(response.elapsed.total_seconds(), 3)}
+        with self.lock:
+            self.calls.append(call)
+            if self.log_file:
+                with open(self.log_file, 'a') as log_file:
+                    log_file.write(json.dumps(dict(
+                        call, time=round(time.time(), 3),
+                        url='%s://%s' % (url.scheme, url.netloc))) + '\n')
+
+    def summary(self):
+        with self.lock:
+            return {'requests': len(self.calls),
+                    'seconds': round(sum(call['seconds']
+                                         for call in self.calls), 3),
+                    'bytes_out': sum(call['bytes_out'] for call in self.calls),
+                    'bytes_in': sum(call['bytes_in'] for call in self.calls),
+                    'calls': list(self.calls)}
+
+
+# --------------------------------------------------------------------------------
+# Error of one agent in agents mode.
+# --------------------------------------------------------------------------------
+class _AgentError(Exception):
+    pass
+
+
 # --------------------------------------------------------------------------------
 # AEMAgent class.
 # --------------------------------------------------------------------------------
 class AEMAgent(object):
     """docstring for AEMAgent"""
 
-    def __init__(self, module):
+    def __init__(self, module, params=None, session=None, listing=None):
+        # params, session and listing are given in agents mode: the options
+        # of one agent, the shared session and the folder read by
+        # reconcile_agents
         self.module = module
-        self.state = self.module.params['state']
-        self.folder = self.module.params['folder']
-        self.name = self.module.params['name']
-        self.title = self.module.params['title']
-        self.description = self.module.params['description']
-        self.transport_uri = self.module.params['transport_uri']
-        self.transport_user = self.module.params['transport_user']
-        self.transport_password = self.module.params['transport_password']
-        self.agent_user = self.module.params['agent_user']
-        self.retry_delay = self.module.params['retry_delay']
-        self.template = self.module.params['template']
-        self.resource_type = self.module.params['resource_type']
-        self.triggers = self.module.params['triggers']
-        self.log_level = self.module.params['log_level']
-        self.serialization_type = self.module.params['serialization_type']
-        self.admin_user = self.module.params['admin_user']
-        self.admin_password = self.module.params['admin_password']
-        self.host = self.module.params['host']
-        self.port = str(self.module.params['port'])
-        self.connect_timeout = self.module.params['connect_timeout']
-        self.protocol_version = self.module.params['protocol_version']
+        self.params = params or self.module.params
+        self.raise_errors = params is not None
+        self.state = self.params['state']
+        self.folder = self.params['folder']
+        self.name = self.params['name']
+        self.title = self.params['title']
+        self.description = self.params['description']
+        self.transport_uri = self.params['transport_uri']
+        self.transport_user = self.params['transport_user']
+        self.transport_password = self.params['transport_password']
+        self.agent_user = self.params['agent_user']
+        self.retry_delay = self.params['retry_delay']
+        self.template = self.params['template']
+        self.resource_type = self.params['resource_type']
+        self.triggers = self.params['triggers']
+        self.log_level = self.params['log_level']
+        self.serialization_type = self.params['serialization_type']
+        self.admin_user = self.params['admin_user']
+        self.admin_password = self.params['admin_password']
+        self.host = self.params['host']
+        self.port = str(self.params['port'])
+        self.connect_timeout = self.params['connect_timeout']
+        self.verify = self.params['verify']
+        self.protocol_version = self.params['protocol_version']
         self.url = self.host + ':' + self.port
         self.auth = (self.admin_user, self.admin_password)
+        if session is None:
+            self.timings = _Timings(self.params['timings_file'])
+            self.session = requests.Session()
+            self.session.auth = self.auth
+            self.session.hooks['response'].append(self.timings.hook)
+        else:
+            self.session = session
 
-        if self.module.params['headers']:
+        if self.params['headers']:
             html = HTMLParser.HTMLParser()
-            headers = html.unescape(self.module.params['headers'])
+            headers = html.unescape(self.params['headers'])
             self.headers = eval(headers)
         else:
             self.headers = None
@@ -217,15 +478,15 @@ class AEMAgent(object):
         if not self.title:
             self.title = self.name
 
-        if self.module.params['connection_close']:
+        if self.params['connection_close']:
             self.connection_close = 'true'
         else:
             self.connection_close = 'false'
 
-        if self.module.params['batch_mode']:
+        if self.params['batch_mode']:
             self.batch_mode = 'true'
-            self.batch_wait_time = self.module.params['batch_wait_time']
-            self.batch_max_size = self.module.params['batch_max_size']
+            self.batch_wait_time = self.params['batch_wait_time']
+            self.batch_max_size = self.params['batch_max_size']
         else:
             self.batch_mode = 'false'
             self.batch_wait_time = ''
@@ -237,8 +498,9 @@ class AEMAgent(object):
 
         self.changed = False
         self.msg = []
+        self.queue = None
 
-        self.get_agent_info()
+        self.get_agent_info(listing)
 
         self.trigger_map = {'no_status_update': 'noStatusUpdate',
                             'no_versioning': 'noVersioning',
@@ -248,23 +510,34 @@ class AEMAgent(object):
                             'on_receive': 'triggerReceive',
                             'ignore_default': 'triggerSpecific',
                             }
-        self.field_map = {}
-        for key, value in self.trigger_map.items():
-            self.field_map[value] = key
 
         if self.triggers:
             for t in self.triggers:
                 if t not in self.trigger_map:
-                    self.module.fail_json(msg="invalid trigger '%s'" % t)
+                    self.fail("invalid trigger '%s'" % t)
 
     # --------------------------------------------------------------------------------
-    # Look up agent info.
+    # Fail the task, or only this agent in agents mode.
     # --------------------------------------------------------------------------------
-    def get_agent_info(self):
-        r = requests.get(self.url + '/etc/replication/%s/%s.4.json' % (self.folder, self.name), auth=self.auth)
-        if r.status_code == 200:
+    def fail(self, msg):
+        if self.raise_errors:
+            raise _AgentError(msg)
+        if self.queue is not None:
+            self.module.fail_json(msg=msg, queue=self.queue)
+        self.module.fail_json(msg=msg)
+
+    # --------------------------------------------------------------------------------
+    # Look up agent info, from the folder listing in agents mode.
+    # --------------------------------------------------------------------------------
+    def get_agent_info(self, listing=None):
+        if listing is None:
+            r = self.session.get(self.url + '/etc/replication/%s/%s.4.json' % (self.folder, self.name), auth=self.auth)
+            info = r.json() if r.status_code == 200 else None
+        else:
+            info = listing.get(self.name)
+        if isinstance(info, dict) and 'jcr:content' in info:
             self.exists = True
-            self.info = r.json()
+            self.info = info
             if 'enabled' in self.info['jcr:content']:
                 self.enabled = self.info['jcr:content']['enabled']
             else:
@@ -276,158 +549,66 @@ class AEMAgent(object):
             self.exists = False
 
     # --------------------------------------------------------------------------------
-    # state='present'
+    # Desired properties of jcr:content: (option, property, value, normalizer).
+    # --------------------------------------------------------------------------------
+    def agent_properties(self):
+        properties = [(option, prop, normalize(getattr(self, option)), missing, normalize)
+                      for option, prop, missing, normalize in AGENT_FIELDS]
+        if self.triggers:
+            for trigger, prop in self.trigger_map.items():
+                properties.append((trigger, prop, 'true' if trigger in self.triggers else 'false', 'false', _flag))
+        if self.headers or self.serialization_type == 'flush':
+            properties.append(('protocol_http_method', 'protocolHTTPMethod', 'GET', '', _text))
+            properties.append(('headers', 'protocolHTTPHeaders', _values(self.headers or FLUSH_HEADERS), None, _values))
+        return properties
+
+    # --------------------------------------------------------------------------------
+    # Properties that differ from the agent node: (option, property, old, new).
+    # --------------------------------------------------------------------------------
+    def diff_agent(self):
+        content = self.info['jcr:content']
+        changes = []
+        for option, prop, value, missing, normalize in self.agent_properties():
+            current = normalize(content.get(prop, missing))
+            if current != value:
+                changes.append((option, prop, current, value))
+        return changes
+
+    # --------------------------------------------------------------------------------
+    # state='present', 'enabled', 'disabled' and 'password'
     # --------------------------------------------------------------------------------
     def present(self):
         if self.exists:
-            # Update existing agent
-            update_required = False
-            if self.title != self.info['jcr:content']['jcr:title']:
-                update_required = True
-                self.msg.append("title updated from '%s' to '%s'" % (self.info['jcr:content']['jcr:title'], self.title))
-
-            if self.description != self.info['jcr:content']['jcr:description']:
-                update_required = True
-                self.msg.append("description updated from '%s' to '%s'" % (
-                    self.info['jcr:content']['jcr:description'], self.description))
-
-            if self.retry_delay != int(self.info['jcr:content']['retryDelay']):
-                update_required = True
-                self.msg.append("retry_delay updated from '%s' to '%s'" % (
-                    self.info['jcr:content']['retryDelay'], self.retry_delay))
-
-            if 'serializationType' not in self.info['jcr:content']:
-                self.info['jcr:content']['serializationType'] = ''
-            if self.serialization_type != self.info['jcr:content']['serializationType']:
-                update_required = True
-                self.msg.append("serialization_type updated from '%s' to '%s'" % (
-                    self.info['jcr:content']['serializationType'], self.serialization_type))
-
-            if self.template != self.info['jcr:content']['template']:
-                update_required = True
-                self.msg.append(
-                    "template updated from '%s' to '%s'" % (self.info['jcr:content']['template'], self.template))
-            if self.transport_uri != self.info['jcr:content']['transportUri']:
-                update_required = True
-                self.msg.append("transport_uri updated from '%s' to '%s'" % (
-                    self.info['jcr:content']['transportUri'], self.transport_uri))
-
-            if 'transportUser' not in self.info['jcr:content']:
-                self.info['jcr:content']['transportUser'] = ''
-            if not self.transport_user:
-                self.transport_user = ""
-            if self.transport_user != self.info['jcr:content']['transportUser']:
-                update_required = True
-                user_changed = True
-                self.msg.append("transport_user updated from '%s' to '%s'" % (
-                    self.info['jcr:content']['transportUser'], self.transport_user))
-
-            else:
-                user_changed = False
-
-            if self.triggers:
-                curr_triggers = []
-                for field in self.info['jcr:content']:
-                    if field in self.field_map and self.info['jcr:content'][field] == 'true':
-                        curr_triggers.append(self.field_map[field])
-                curr_triggers.sort()
-                self.triggers.sort()
-                t1 = ','.join(curr_triggers)
-                t2 = ','.join(self.triggers)
-                if t1 != t2:
-                    update_required = True
-                    self.msg.append("triggers updated from '%s' to '%s'" % (t1, t2))
-
-            if 'logLevel' not in self.info['jcr:content']:
-                self.info['jcr:content']['logLevel'] = 'info'
-            if self.log_level != self.info['jcr:content'].get('logLevel'):
-                update_required = True
-                self.msg.append(
-                    "log level updated from '%s' to '%s'" % (self.info['jcr:content']['logLevel'], self.log_level))
-
-            if 'protocolHTTPConnectionClose' not in self.info['jcr:content']:
-                self.info['jcr:content']['protocolHTTPConnectionClose'] = 'false'
-            if self.connection_close != self.info['jcr:content']['protocolHTTPConnectionClose']:
-                update_required = True
-                self.msg.append("protocol HTTP close updated from '%s' to '%s'" % (
-                    self.info['jcr:content']['protocolHTTPConnectionClose'], self.connection_close))
-
-            if 'protocolConnectTimeout' not in self.info['jcr:content']:
-                self.info['jcr:content']['protocolConnectTimeout'] = ''
-            if self.connect_timeout != self.info['jcr:content']['protocolConnectTimeout']:
-                update_required = True
-                self.msg.append("connection timeout updated from '%s' to '%s'" % (
-                    self.info['jcr:content']['protocolConnectTimeout'], self.connect_timeout))
-
-            if 'protocolVersion' not in self.info['jcr:content']:
-                self.info['jcr:content']['protocolVersion'] = ''
-            if self.protocol_version != self.info['jcr:content']['protocolVersion']:
-                update_required = True
-                self.msg.append("protocol version updated from '%s' to '%s'" % (
-                    self.info['jcr:content']['protocolVersion'], self.protocol_version))
-
-            if 'userId' not in self.info['jcr:content']:
-                self.info['jcr:content']['userId'] = ''
-            if self.agent_user != self.info['jcr:content']['userId']:
-                update_required = True
-                self.msg.append(
-                    "agent user ID updated from '%s' to '%s'" % (self.info['jcr:content']['userId'], self.agent_user))
-
-            if self.serialization_type == 'flush':
-                if 'protocolHTTPMethod' not in self.info['jcr:content']:
-                    update_required = True
-                    self.msg.append("protocol HTTP method set to '%s'" % ('GET'))
-                elif self.info['jcr:content']['protocolHTTPMethod'] != 'GET':
-                    update_required = True
-                    self.msg.append("protocol HTTP method updated from '%s' to '%s'" % (
-                        self.info['jcr:content']['protocolHTTPMethod'], 'GET'))
-
-                if self.headers:
-                    flush_headers = ','.join(self.headers)
-                else:
-                    flush_headers = "CQ-Action:{action},CQ-Handle:{path},CQ-Path:{path}"
-                if 'protocolHTTPHeaders' not in self.info['jcr:content']:
-                    update_required = True
-                    self.msg.append("protol HTTP headers'%s'" % (flush_headers))
-                else:
-                    curr_headers = ','.join(self.info['jcr:content']['protocolHTTPHeaders'])
-                    if curr_headers != flush_headers:
-                        update_required = True
-                        self.msg.append("protol HTTP headers updated from '%s' to '%s'" % (curr_headers, flush_headers))
-
-            if 'queueBatchMode' not in self.info['jcr:content']:
-                self.info['jcr:content']['queueBatchMode'] = ''
-            if self.batch_mode != self.info['jcr:content']['queueBatchMode']:
-                update_required = True
-                self.msg.append("batch mode changed from '%s' to '%s'" % (
-                    self.info['jcr:content']['queueBatchMode'], self.batch_mode))
-
-            if 'queueBatchWaitTime' not in self.info['jcr:content']:
-                self.info['jcr:content']['queueBatchWaitTime'] = ''
-            if self.batch_wait_time != self.info['jcr:content']['queueBatchWaitTime']:
-                update_required = True
-                self.msg.append("batch wait time changed from '%s' to '%s'" % (
-                    self.info['jcr:content']['queueBatchWaitTime'], self.batch_wait_time))
-
-            if 'queueBatchMaxSize' not in self.info['jcr:content']:
-                self.info['jcr:content']['queueBatchMaxSize'] = ''
-            if self.batch_max_size != self.info['jcr:content']['queueBatchMaxSize']:
-                update_required = True
-                self.msg.append("batch max size changed from '%s' to '%s'" % (
-                    self.info['jcr:content']['queueBatchMaxSize'], self.batch_max_size))
-
-            if self.state == 'present':
-                self.enable()
-            elif self.state == 'enabled':
-                self.enable()
-            elif self.state == 'disabled':
-                self.disable()
-            elif self.state == 'password':
-                self.password()
-            if update_required:
-                if not user_changed:
-                    self.transport_password = None
-                self.define_agent()
+            # Update existing agent, property changes, enabled and password
+            # are written together
+            changes = self.diff_agent()
+            user_changed = False
+            for option, prop, old, new in changes:
+                if isinstance(new, list):
+                    old, new = ','.join(old), ','.join(new)
+                self.msg.append("%s updated from '%s' to '%s'" % (option, old, new))
+                user_changed = user_changed or prop == 'transportUser'
+            if user_changed and self.transport_password:
+                changes.append(('transport_password', 'transportPassword', None, self.transport_password))
+
+            enabled = {'present': 'true', 'enabled': 'true', 'disabled': 'false'}.get(self.state)
+            if enabled == self.enabled:
+                self.msg.append('agent already %s' % ('enabled' if enabled == 'true' else 'disabled'))
+            elif enabled:
+                changes.append(('enabled', 'enabled', self.enabled, enabled))
+                self.msg.append('agent %s' % ('enabled' if enabled == 'true' else 'disabled'))
+
+            if self.state == 'password':
+                if not self.transport_password:
+                    self.fail('Missing required argument: transport_password')
+                if self.transport_password == self.info['jcr:content'].get('transportPassword'):
+                    self.msg.append('old password equal to new')
+                elif not user_changed:
+                    changes.append(('transport_password', 'transportPassword', None, self.transport_password))
+                    self.msg.append('password changed')
+
+            if changes:
+                self.define_agent(changes)
             self.msg.append('agent updated')
         else:
             # Create a new agent
@@ -442,151 +623,134 @@ class AEMAgent(object):
             self.delete_agent()
 
     # --------------------------------------------------------------------------------
-    # service='enabled'
-    # --------------------------------------------------------------------------------
-    def enable(self):
-        if self.exists:
-            self.enable_agent()
-        else:
-            self.module.fail_json(msg="can't find agent '/etc/replication/%s/%s'" % (self.folder, self.name))
-
-    # --------------------------------------------------------------------------------
-    # service='disabled'
-    # --------------------------------------------------------------------------------
-    def disable(self):
-        if self.exists:
-            self.disable_agent()
-        else:
-            self.module.fail_json(msg="can't find agent '/etc/replication/%s/%s'" % (self.folder, self.name))
-
+    # Create a new agent or write changes of an existing one, in one POST
     # --------------------------------------------------------------------------------
-    # service='password'
-    # --------------------------------------------------------------------------------
-    def password(self):
-        if self.exists:
-            if not self.transport_password:
-                self.module.fail_json(msg='Missing required argument: transport_password')
-            self.set_password()
-        else:
-            self.module.fail_json(msg="can't find agent '/etc/replication/%s/%s'" % (self.folder, self.name))
-
-    # --------------------------------------------------------------------------------
-    # Create a new agent
-    # --------------------------------------------------------------------------------
-    def define_agent(self):
+    def define_agent(self, changes=None):
+        # a new agent gets every property, an existing one only the changes
         if not self.transport_uri:
-            self.module.fail_json(msg='Missing required argument: transport_uri')
-
-        fields = [
-            ('jcr:primaryType', 'cq:Page'),
-            ('jcr:content/jcr:title', self.title),
-            ('jcr:content/jcr:description', self.description),
-            ('jcr:content/sling:resourceType', self.resource_type),
-            ('jcr:content/template', self.template),
-            ('jcr:content/transportUri', self.transport_uri),
-            ('jcr:content/retryDelay', self.retry_delay),
-            ('jcr:content/serializationType', self.serialization_type),
-            ('jcr:content/logLevel', self.log_level),
-            ('jcr:content/protocolHTTPConnectionClose', self.connection_close),
-            ('jcr:content/userId', self.agent_user),
-            ('jcr:content/protocolConnectTimeout', self.connect_timeout),
-            ('jcr:content/protocolVersion', self.protocol_version),
-            ('jcr:content/queueBatchMode', self.batch_mode),
-            ('jcr:content/queueBatchWaitTime', self.batch_wait_time),
-            ('jcr:content/queueBatchMaxSize', self.batch_max_size),
-        ]
-        if self.transport_user:
-            fields.append(('jcr:content/transportUser', self.transport_user))
-        if self.transport_password:
-            fields.append(('jcr:content/transportPassword', self.transport_password))
-        if self.headers:
-            fields.append(('jcr:content/protocolHTTPMethod', 'GET'))
-            for h in self.headers:
-                fields.append(('jcr:content/protocolHTTPHeaders', h))
+            self.fail('Missing required argument: transport_uri')
+
+        created = changes is None
+        if created:
+            fields = [
+                ('jcr:primaryType', 'cq:Page'),
+                ('jcr:content/sling:resourceType', self.resource_type),
+            ]
+            changes = [(option, prop, None, value) for option, prop, value, missing, normalize in self.agent_properties()]
+            if self.state in ["present", "enabled"]:
+                changes.append(('enabled', 'enabled', None, 'true'))
+            elif self.state == "disabled":
+                changes.append(('enabled', 'enabled', None, 'false'))
+            if self.transport_password:
+                changes.append(('transport_password', 'transportPassword', None, self.transport_password))
         else:
-            if self.serialization_type == 'flush':
-                fields.append(('jcr:content/protocolHTTPMethod', 'GET'))
-                fields.append(('jcr:content/protocolHTTPHeaders', 'CQ-Action:{action}'))
-                fields.append(('jcr:content/protocolHTTPHeaders', 'CQ-Handle:{path}'))
-                fields.append(('jcr:content/protocolHTTPHeaders', 'CQ-Path:{path}'))
-
-        if self.state in ["present", "enabled"]:
-            fields.append(('jcr:content/enabled', "true"))
-        elif self.state == "disabled":
-            fields.append(('jcr:content/enabled', "false"))
+            fields = []
+        for option, prop, old, new in changes:
+            for value in (new if isinstance(new, list) else [new]):
+                fields.append(('jcr:content/%s' % prop, value))
 
-        if self.triggers:
-            trigger_setting = {}
-            for t in self.trigger_map:
-                trigger_setting[t] = 'false'
-            for t in self.triggers:
-                trigger_setting[t] = 'true'
-            for k, v in trigger_setting.items():
-                fields.append(('jcr:content/%s' % self.trigger_map[k], v))
         if not self.module.check_mode:
-            r = requests.post(self.url + '/etc/replication/%s/%s' % (self.folder, self.name), auth=self.auth,
-                              data=fields)
-            self.get_agent_info()
-            if r.status_code < 200 or r.status_code > 299 or not self.exists:
-                self.module.fail_json(msg='failed to create agent: %s - %s' % (r.status_code, r.text))
+            r = self.session.post(self.url + '/etc/replication/%s/%s' % (self.folder, self.name), auth=self.auth,
+                                  data=fields)
+            if r.status_code < 200 or r.status_code > 299:
+                self.fail('failed to %s agent: %s - %s' % ('create' if created else 'update', r.status_code, r.text))
+            self.exists = True
+            if self.verify:
+                self.verify_agent(changes)
         self.changed = True
 
+    # --------------------------------------------------------------------------------
+    # Read the agent back and compare the written properties
+    # --------------------------------------------------------------------------------
+    def verify_agent(self, changes):
+        self.get_agent_info()
+        if not self.exists:
+            self.fail("can't find agent '/etc/replication/%s/%s' after writing it" % (self.folder, self.name))
+        content = self.info['jcr:content']
+        # the read-back value is normalized like in diff_agent, a boolean
+        # property comes back as JSON true
+        normalizers = dict((prop, (missing, normalize))
+                           for option, prop, value, missing, normalize in self.agent_properties())
+        normalizers['enabled'] = ('false', _flag)
+        differ = []
+        for option, prop, old, new in changes:
+            if prop == 'transportPassword':
+                continue
+            missing, normalize = normalizers.get(prop, (None, _text))
+            if normalize(content.get(prop, missing)) != new:
+                differ.append(option)
+        if differ:
+            self.fail('agent was written but %s differ' % ', '.join(differ))
+
     # --------------------------------------------------------------------------------
     # Delete a agent
     # --------------------------------------------------------------------------------
     def delete_agent(self):
         if not self.module.check_mode:
             r_data = {':operation': 'delete'}
-            r = requests.post(self.url + '/etc/replication/%s/%s' % (self.folder, self.name), auth=self.auth, data=r_data)
+            r = self.session.post(self.url + '/etc/replication/%s/%s' % (self.folder, self.name), auth=self.auth, data=r_data)
             if r.status_code != 204:
-                self.module.fail_json(msg='failed to delete agent: %s - %s' % (r.status_code, r.text))
+                self.fail('failed to delete agent: %s - %s' % (r.status_code, r.text))
         self.changed = True
         self.msg.append('agent deleted')
 
     # --------------------------------------------------------------------------------
-    # Enable agent
+    # state='drained': poll the replication queue until it is empty.
     # --------------------------------------------------------------------------------
-    def enable_agent(self):
-        fields = [('jcr:content/enabled', 'true')]
-        if not self.module.check_mode and self.enabled != "true":
-            r = requests.post(self.url + '/etc/replication/%s/%s' % (self.folder, self.name), auth=self.auth,
-                              data=fields)
+    def drain(self):
+        if not self.exists:
+            self.fail("can't find agent '/etc/replication/%s/%s'" % (self.folder, self.name))
+
+        poll_interval = max(0.1, self.params['poll_interval'])
+        max_poll_interval = max(poll_interval, self.params['max_poll_interval'])
+        started = time.time()
+        interval = poll_interval
+        lowest = None
+        head = None
+        head_since = started
+        # depth over time as [seconds since start, items in queue]
+        self.queue = {'depth': [], 'initial': None, 'blocked': False}
+        while True:
+            r = self.session.get(self.url + '/etc/replication/%s/%s/jcr:content.queue.json' % (self.folder, self.name),
+                                 auth=self.auth)
             if r.status_code != 200:
-                self.module.fail_json(msg='failed to enable agent: %s - %s' % (r.status_code, r.text))
-            self.changed = True
-            self.msg.append('agent enabled')
-        else:
-            self.msg.append('agent already enabled')
-
-    # --------------------------------------------------------------------------------
-    # Disable agent
-    # --------------------------------------------------------------------------------
-    def disable_agent(self):
-        fields = [('jcr:content/enabled', 'false')]
-        if not self.module.check_mode and self.enabled != "false":
-            r = requests.post(self.url + '/etc/replication/%s/%s' % (self.folder, self.name), auth=self.auth,
-                              data=fields)
-            if r.status_code != 200:
-                self.module.fail_json(msg='failed to disable agent: %s - %s' % (r.status_code, r.text))
-            self.changed = True
-            self.msg.append('agent disabled')
-        else:
-            self.msg.append('agent already disabled')
+                self.fail('failed to read queue of agent: %s - %s' % (r.status_code, r.text))
+            info = r.json()
+            items = info.get('queue') or []
+            now = time.time()
+            elapsed = now - started
+            depth = len(items)
+            status = info.get('metaData', {}).get('queueStatus', {})
+            self.queue['blocked'] = bool(status.get('isBlocked'))
+            self.queue['depth'].append([round(elapsed, 3), depth])
+            if self.queue['initial'] is None:
+                self.queue['initial'] = depth
+            self.queue['seconds'] = round(elapsed, 3)
+            self.queue['throughput'] = round((self.queue['initial'] - depth) / elapsed, 3) if elapsed else 0
+            if depth == 0:
+                break
+
+            # the same head item for stuck_timeout seconds means the queue is stuck
+            if items[0].get('id') != head:
+                head = items[0].get('id')
+                head_since = now
+            elif now - head_since >= self.params['stuck_timeout']:
+                self.queue['stuck'] = items[0]
+                self.fail("queue stuck at '%s' for %d seconds, %d items left"
+                          % (items[0].get('path'), now - head_since, depth))
+
+            # poll faster while the queue shrinks, back off while it does not
+            if lowest is None or depth < lowest:
+                lowest = depth
+                interval = poll_interval
+            else:
+                interval = min(interval * 2, max_poll_interval)
+            remaining = self.params['drain_timeout'] - elapsed
+            if remaining <= 0:
+                self.fail('queue not drained after %d seconds, %d items left' % (elapsed, depth))
+            time.sleep(min(interval, remaining))
 
-    # --------------------------------------------------------------------------------
-    # Set password
-    # --------------------------------------------------------------------------------
-    def set_password(self):
-        fields = [('jcr:content/transportPassword', self.transport_password)]
-        if not self.module.check_mode and self.transport_password != self.info['jcr:content']["transportPassword"]:
-            r = requests.post(self.url + '/etc/replication/%s/%s' % (self.folder, self.name), auth=self.auth,
-                              data=fields)
-            if r.status_code != 200:
-                self.module.fail_json(msg='failed to change password: %s - %s' % (r.status_code, r.text))
-            self.changed = True
-            self.msg.append('password changed')
-        else:
-            self.msg.append('old password equal to new')
+        self.msg.append('queue drained')
 
     # --------------------------------------------------------------------------------
     # Return status and msg to Ansible.
@@ -594,9 +758,180 @@ class AEMAgent(object):
     def exit_status(self):
         if self.changed:
             msg = ','.join(self.msg)
-            self.module.exit_json(changed=True, msg=msg)
+            self.module.exit_json(changed=True, msg=msg,
+                                  timings=self.timings.summary())
+        elif self.queue is not None:
+            self.module.exit_json(changed=False, msg=','.join(self.msg), queue=self.queue,
+                                  timings=self.timings.summary())
         else:
-            self.module.exit_json(changed=False)
+            self.module.exit_json(changed=False,
+                                  timings=self.timings.summary())
+
+
+# --------------------------------------------------------------------------------
+# Session shared by the agents of agents and dispatchers mode.
+# --------------------------------------------------------------------------------
+def _agents_session(params, nodes=1):
+    concurrency = max(1, params['concurrency'])
+    timings = _Timings(params['timings_file'])
+    session = requests.Session()
+    session.auth = (params['admin_user'], params['admin_password'])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=nodes, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(timings.hook)
+    return session, timings
+
+
+# --------------------------------------------------------------------------------
+# Read all agents of a folder with one request.
+# --------------------------------------------------------------------------------
+def _folder_listing(session, url, folder):
+    r = session.get(url + '/etc/replication/%s.4.json' % folder)
+    if r.status_code == 404:
+        return {}
+    if r.status_code != 200:
+        raise _AgentError('failed to read agents of %s: %s - %s' % (folder, r.status_code, r.text))
+    return r.json()
+
+
+# --------------------------------------------------------------------------------
+# Compare agents with the listing and write the changed ones concurrently.
+# --------------------------------------------------------------------------------
+def _apply_agents(module, session, listing, items):
+    def apply(agent_params):
+        agent = None
+        try:
+            agent = AEMAgent(module, agent_params, session, listing)
+            if agent.state == 'absent':
+                agent.absent()
+            elif agent.state == 'drained':
+                agent.drain()
+            else:
+                agent.present()
+            result = {'name': agent.name, 'changed': agent.changed, 'msg': ','.join(agent.msg)}
+        except (_AgentError, requests.exceptions.RequestException) as e:
+            # a node that drops in the middle fails its remaining agents, not the task
+            result = {'name': agent_params['name'], 'changed': False, 'failed': True, 'msg': str(e)}
+        if agent is not None and agent.queue is not None:
+            result['queue'] = agent.queue
+        return result
+
+    pool = ThreadPool(min(max(1, module.params['concurrency']), len(items)) or 1)
+    try:
+        return pool.map(apply, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# --------------------------------------------------------------------------------
+# agents mode: one folder listing, concurrent writes of the changed agents.
+# --------------------------------------------------------------------------------
+def reconcile_agents(module):
+    params = module.params
+    session, timings = _agents_session(params)
+
+    url = params['host'] + ':' + str(params['port'])
+    try:
+        listing = _folder_listing(session, url, params['folder'])
+    except (_AgentError, requests.exceptions.RequestException) as e:
+        module.fail_json(msg=str(e), timings=timings.summary())
+
+    # options not set in an item come from the task
+    items = []
+    for item in params['agents']:
+        agent_params = dict(params)
+        agent_params.update((k, v) for k, v in item.items() if v is not None)
+        items.append(agent_params)
+
+    results = _apply_agents(module, session, listing, items)
+
+    changed = any(result['changed'] for result in results)
+    failed = [result['name'] for result in results if result.get('failed')]
+    if failed:
+        module.fail_json(msg='failed to reconcile agents %s' % ', '.join(failed), changed=changed,
+                         agents=results, timings=timings.summary())
+    msg = ', '.join(result['name'] for result in results if result['changed'])
+    module.exit_json(changed=changed, msg='agents changed: %s' % msg if changed else 'no changes',
+                     agents=results, timings=timings.summary())
+
+
+# --------------------------------------------------------------------------------
+# Name and transport URI of the flush agent of every dispatcher.
+# --------------------------------------------------------------------------------
+def _dispatcher_agents(dispatchers, name_template):
+    agents = []
+    for index, dispatcher in enumerate(dispatchers, 1):
+        uri = urlparse(dispatcher)
+        label = re.sub('[^A-Za-z0-9_-]', '_', uri.hostname or dispatcher)
+        if uri.path in ['', '/']:
+            dispatcher = dispatcher.rstrip('/') + FLUSH_PATH
+        agents.append((name_template.format(dispatcher=label, index=index), dispatcher))
+    return agents
+
+
+# --------------------------------------------------------------------------------
+# dispatchers mode: flush agents of all dispatchers on every node.
+# --------------------------------------------------------------------------------
+def flush_agents(module):
+    params = module.params
+    prefix = params['name_template'].split('{')[0]
+    if params['delete_stale'] and not prefix:
+        module.fail_json(msg="name_template must start with a fixed prefix with delete_stale: '%s'" % params['name_template'])
+    try:
+        generated = _dispatcher_agents(params['dispatchers'], params['name_template'])
+    except (KeyError, IndexError, ValueError) as e:
+        module.fail_json(msg="invalid name_template '%s': %s" % (params['name_template'], e))
+    names = [name for name, uri in generated]
+    if len(set(names)) != len(names):
+        module.fail_json(msg="name_template '%s' gives the same name to several dispatchers: %s"
+                         % (params['name_template'], ', '.join(names)))
+
+    nodes = params['nodes'] or [params['host'] + ':' + str(params['port'])]
+    session, timings = _agents_session(params, len(nodes))
+
+    def reconcile_node(node):
+        url = urlparse(node)
+        node_params = dict(params, host='%s://%s' % (url.scheme, url.hostname),
+                           port=url.port or (443 if url.scheme == 'https' else 80))
+        try:
+            listing = _folder_listing(session, node, params['folder'])
+        except (_AgentError, requests.exceptions.RequestException) as e:
+            return {'node': node, 'changed': False, 'failed': True, 'msg': str(e), 'agents': []}
+
+        items = [dict(node_params, name=name, transport_uri=uri, serialization_type='flush')
+                 for name, uri in generated]
+        # flush agents with the prefix of name_template no dispatcher maps to any more
+        if params['delete_stale'] and params['state'] != 'drained':
+            for name, info in sorted(listing.items()):
+                content = info.get('jcr:content') if isinstance(info, dict) else None
+                if name.startswith(prefix) and name not in names and isinstance(content, dict) and \
+                        content.get('serializationType') == 'flush':
+                    items.append(dict(node_params, name=name, state='absent'))
+
+        results = _apply_agents(module, session, listing, items)
+        failed = [result['name'] for result in results if result.get('failed')]
+        result = {'node': node, 'changed': any(result['changed'] for result in results), 'agents': results}
+        if failed:
+            result.update(failed=True, msg='failed to reconcile agents %s' % ', '.join(failed))
+        return result
+
+    pool = ThreadPool(len(nodes))
+    try:
+        results = pool.map(reconcile_node, nodes)
+    finally:
+        pool.close()
+        pool.join()
+
+    changed = any(result['changed'] for result in results)
+    failed = [result['node'] for result in results if result.get('failed')]
+    if failed:
+        module.fail_json(msg='failed to reconcile flush agents on %s' % ', '.join(failed), changed=changed,
+                         nodes=results, timings=timings.summary())
+    msg = ', '.join(result['node'] for result in results if result['changed'])
+    module.exit_json(changed=changed, msg='flush agents changed on: %s' % msg if changed else 'no changes',
+                     nodes=results, timings=timings.summary())
 
 
 # --------------------------------------------------------------------------------
@@ -605,9 +940,20 @@ class AEMAgent(object):
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            state=dict(required=True, choices=['present', 'absent', 'enabled', 'disabled', 'password']),
+            state=dict(required=True, choices=['present', 'absent', 'enabled', 'disabled', 'password', 'drained']),
             folder=dict(required=True),
-            name=dict(required=True),
+            name=dict(required=False),
+            agents=dict(default=None, type='list', elements='dict', options=AGENT_OPTIONS),
+            dispatchers=dict(default=None, type='list', elements='str'),
+            name_template=dict(default='flush_{dispatcher}'),
+            delete_stale=dict(default=False, type='bool'),
+            nodes=dict(default=None, type='list', elements='str'),
+            concurrency=dict(default=4, type='int'),
+            verify=dict(default=False, type='bool'),
+            drain_timeout=dict(default=600, type='int'),
+            poll_interval=dict(default=1, type='float'),
+            max_poll_interval=dict(default=30, type='float'),
+            stuck_timeout=dict(default=300, type='int'),
             title=dict(default=None),
             description=dict(default=None),
             transport_uri=dict(default=None),
@@ -622,19 +968,29 @@ def main():
             serialization_type=dict(default='durbo'),
             admin_user=dict(required=True),
             admin_password=dict(required=True, no_log=True),
-            host=dict(required=True),
-            port=dict(required=True, type='int'),
+            host=dict(required=False),
+            port=dict(required=False, type='int'),
             headers=dict(default=None),
             connection_close=dict(default=False, type='bool'),
             connect_timeout=dict(default=''),
             protocol_version=dict(default=''),
             batch_mode=dict(default=False, type='bool'),
             batch_wait_time=dict(default=''),
-            batch_max_size=dict(default='')
+            batch_max_size=dict(default=''),
+            timings_file=dict(default=None, type='path')
         ),
+        required_one_of=[['name', 'agents', 'dispatchers'], ['host', 'nodes']],
+        mutually_exclusive=[['name', 'agents', 'dispatchers']],
+        required_together=[['host', 'port']],
+        required_by={'nodes': 'dispatchers'},
         supports_check_mode=True
     )
 
+    if module.params['agents']:
+        reconcile_agents(module)
+    if module.params['dispatchers']:
+        flush_agents(module)
+
     agent = AEMAgent(module)
 
     state = module.params['state']
@@ -643,6 +999,8 @@ def main():
         agent.present()
     elif state == 'absent':
         agent.absent()
+    elif state == 'drained':
+        agent.drain()
     else:
         module.fail_json(msg='Invalid state: %s' % state)
 
@@ -5,7 +5,21 @@
 # GNU General Public License v3.0+ (see COPYING or
 # https://www.gnu.org/licenses/gpl-3.0.txt)
 
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from multiprocessing.pool import ThreadPool
 import requests
+from requests.compat import urlparse
 from ansible.module_utils.basic import *
 
 ANSIBLE_METADATA = {'metadata_version': '1.1',
@@ -25,12 +39,106 @@ options:
     name:
         description:
             - The name of the bundle
-        required: true
+            - One of name, names or name_regex is required
+        required: false
+    names:
+        description:
+            - Symbolic names of bundles to handle in one task, shell-style
+              wildcards are allowed. Bundle state is read once from
+              bundles.json and the action is sent only to bundles that need
+              it
+        required: false
+    name_regex:
+        description:
+            - Regular expression for symbolic names of bundles to handle in
+              one task, can be combined with names
+        required: false
+    concurrency:
+        description:
+            - Number of actions sent in parallel with names or name_regex
+        required: false
+        default: 4
+    ordered:
+        description:
+            - With names or name_regex, order the actions by the package
+              imports between the selected bundles, read from the bundle
+              details. Providers are started before and stopped after the
+              bundles importing from them, independent bundles are handled
+              in parallel. refresh is sent only to bundles that are not
+              refreshed already by the cascade from another selected
+              bundle, so every refresh cycle of the framework counts
+        required: false
+        default: false
+        type: bool
     action:
         description:
             - start, stop or refresh the Bundle
         required: true
         choices: [start, stop, refresh]
+    state:
+        description:
+            - all_active waits until every bundle except fragments is
+              Active, no action is performed
+            - installed uploads the jars to the web console, a bundle with
+              the same symbolic name is updated. A jar is skipped when the
+              running bundle has its Bundle-Version and, if the jar was
+              installed on the node before or the version is a SNAPSHOT,
+              the recorded sha256 of that jar matches
+        required: false
+        choices: [all_active, installed]
+    jars:
+        description:
+            - Paths of the bundle jars for state installed, uploaded
+              concurrently and streamed from disk
+        required: false
+    start:
+        description:
+            - Start the bundles after installation
+        required: false
+        default: true
+        type: bool
+    start_level:
+        description:
+            - Start level of installed bundles
+        required: false
+        default: 20
+    refresh_packages:
+        description:
+            - Refresh packages after installation
+        required: false
+        default: true
+        type: bool
+    jar_manifest:
+        description:
+            - File with the sha256 of jars installed on every node
+        required: false
+        default: ~/.ansible/aem_bundle_manifest.json
+    wait_timeout:
+        description:
+            - Seconds to wait for all_active
+        required: false
+        default: 600
+    poll_interval:
+        description:
+            - First delay between bundles.json polls in seconds, it doubles
+              with random jitter up to 30 seconds
+        required: false
+        default: 1
+    cache_ttl:
+        description:
+            - Seconds a bundles.json snapshot of a node is reused by later
+              tasks, 0 disables the cache. Any action marks the snapshot of
+              the node as stale. When a fresh snapshot replaces an older
+              one, the result has a diff of bundles that were added,
+              removed or changed state or version
+        required: false
+        default: 0
+    cache_dir:
+        description:
+            - Directory for the snapshots, one file per node URL. Use
+              delegate_to localhost to keep it on the controller
+        required: false
+        default: ~/.ansible/tmp/aem_bundle
     admin_user:
         description:
             - AEM admin user account name
@@ -43,6 +151,12 @@ options:
         description:
             - URL of AEM node
         required: true
+    timings_file:
+        description:
+            - Every HTTP call is returned in timings with method, path,
+              status, bytes and latency, and also appended as a JSON line
+              to this file when it is set
+        required: false
 '''
 
 EXAMPLES = u'''
@@ -69,8 +183,173 @@ EXAMPLES = u'''
     admin_user: admin
     admin_password: pa$$w0rd
     url: https://aem-node.example.com:4502
+
+# Start several AEM bundles with a single bundles.json request
+- aem_bundle:
+    names:
+      - com.adobe.granite.*
+      - com.day.crx.crxde-support
+    name_regex: '^com\\.example\\.'
+    action: start
+    concurrency: 8
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
+# Refresh a set of AEM bundles with as few framework refreshes as possible
+- aem_bundle:
+    names:
+      - com.example.*
+    action: refresh
+    ordered: true
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
+# Install or update bundles from local jars, unchanged jars are skipped
+- aem_bundle:
+    state: installed
+    jars:
+      - /tmp/hotfix/com.example.core-1.2.1.jar
+      - /tmp/hotfix/com.example.models-1.2.1.jar
+    start_level: 20
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
+
+# Wait until all AEM bundles are active after a deploy, with cache_ttl the
+# result has a diff against the snapshot taken by an earlier task
+- aem_bundle:
+    state: all_active
+    wait_timeout: 900
+    cache_ttl: 60
+    admin_user: admin
+    admin_password: pa$$w0rd
+    url: https://aem-node.example.com:4502
 '''
 
+GLOB_CHARS = re.compile(r'[*?[]')
+MAX_POLL_INTERVAL = 30
+# order of the status counters in the s array of bundles.json
+BUNDLE_COUNTERS = ['total', 'active', 'fragment', 'resolved', 'installed']
+# bundle properties kept in a snapshot
+SNAPSHOT_FIELDS = ['id', 'symbolicName', 'version', 'state', 'fragment']
+# links to the exporting bundles in the Imported Packages of bundle details
+PROVIDER_LINK = re.compile(r'/system/console/bundles/(\d+)')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _osgi_version(version):
+    # major.minor.micro[.qualifier] like the console reports it, Bundle-Version
+    # 1.2 of a jar is 1.2.0 in Felix
+    parts = version.strip().split('.', 3)
+    try:
+        numbers = [str(int(part)) for part in parts[:3]]
+    except ValueError:
+        return version.strip()
+    numbers += ['0'] * (3 - len(numbers))
+    return '.'.join(numbers + [part for part in parts[3:] if part])
+
+
+def _makedirs(path):
+    # another fork may create the directory at the same time
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def _write_json(path, data, **kwargs):
+    # every writer gets its own temp file next to path, the rename replaces
+    # path atomically
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.', suffix='.tmp',
+        dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(tmp_fd, 'w') as tmp_file:
+            json.dump(data, tmp_file, **kwargs)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class _MultipartBody(object):
+    """multipart/form-data body streamed from disk in fixed-size chunks"""
+
+    def __init__(self, field_name, file_path, fields=None,
+                 chunk_size=UPLOAD_CHUNK_SIZE):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+
+        head = []
+        for key, value in (fields or {}).items():
+            head.append('--%s\r\nContent-Disposition: form-data; name="%s"'
+                        '\r\n\r\n%s\r\n' % (boundary, key, value))
+        head.append('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                    'filename="%s"\r\nContent-Type: application/java-archive'
+                    '\r\n\r\n' % (boundary, field_name,
+                                  os.path.basename(file_path)))
+        self.head = ''.join(head).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self.file_size = os.path.getsize(file_path)
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.file_path, 'rb') as jar:
+            chunk = jar.read(self.chunk_size)
+            while chunk:
+                yield chunk
+                chunk = jar.read(self.chunk_size)
+        yield self.tail
+
+
+class _Timings(object):
+    """method, path, status, bytes and latency of every HTTP call of a
+    session, recorded by its response hook"""
+
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def hook(self, response, *args, **kwargs):
+        # runs before the body is read, so bytes_in is the Content-Length
+        # and seconds is the time until the response headers arrived
+        url = urlparse(response.request.url)
+        call = {'method': response.request.method,
+                'path': url.path + ('?' + url.query if url.query else ''),
+                'status': response.status_code,
+                'bytes_out': int(response.request.headers.get(
+                    'Content-Length') or 0),
+                'bytes_in': int(response.headers.get('Content-Length') or 0),
+                'seconds': round(response.elapsed.total_seconds(), 3)}
+        with self.lock:
+            self.calls.append(call)
+            if self.log_file:
+                with open(self.log_file, 'a') as log_file:
+                    log_file.write(json.dumps(dict(
+                        call, time=round(time.time(), 3),
+                        url='%s://%s' % (url.scheme, url.netloc))) + '\n')
+
+    def summary(self):
+        with self.lock:
+            return {'requests': len(self.calls),
+                    'seconds': round(sum(call['seconds']
+                                         for call in self.calls), 3),
+                    'bytes_out': sum(call['bytes_out'] for call in self.calls),
+                    'bytes_in': sum(call['bytes_in'] for call in self.calls),
+                    'calls': list(self.calls)}
+
 
 class AEMBundle(object):
     """docstring for AEMBundle"""
@@ -79,19 +358,49 @@ class AEMBundle(object):
         # super(AEMBundle, self).__init__()
         self.module = arg
         self.name = self.module.params['name']
+        self.names = self.module.params['names'] or []
+        self.name_regex = self.module.params['name_regex']
         self.action = self.module.params['action']
+        self.state = self.module.params['state']
         self.admin_user = self.module.params['admin_user']
         self.admin_password = self.module.params['admin_password']
         self.url = self.module.params['url']
+        self.concurrency = max(1, self.module.params['concurrency'])
+        self.ordered = self.module.params['ordered']
+        self.jars = self.module.params['jars'] or []
+        self.cache_ttl = self.module.params['cache_ttl']
+        self.cache_dir = self.module.params['cache_dir']
         self.changed = False
         self.msg = []
-        self._get_bnd_status()
+        self.bundles = []
+        self.result = {}
+        self.timings = _Timings(self.module.params['timings_file'])
+        self.session = self._session()
+        if self.name:
+            self._get_bnd_status()
+
+    def _session(self):
+        # one keep-alive session per task, sized for the concurrent actions
+        session = requests.Session()
+        session.auth = (self.admin_user, self.admin_password)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(self.timings.hook)
+        return session
 
     def _get_bnd_status(self):
-        aem_request = requests.get('%s/system/console/bundles/%s.json' %
-                                   (self.url, self.name),
-                                   auth=(self.admin_user,
-                                         self.admin_password))
+        cached = self._cached_bundles()
+        if cached is not None:
+            matches = [bundle for bundle in cached
+                       if self.name in [bundle['symbolicName'],
+                                        str(bundle['id'])]]
+            self.exists = bool(matches)
+            self.active = self.exists and matches[0]['state'] == 'Active'
+            return
+        aem_request = self.session.get('%s/system/console/bundles/%s.json' %
+                                       (self.url, self.name))
         if aem_request.status_code == 200:
             self.exists = True
             if aem_request.json()['data'][0]['state'] == 'Active':
@@ -103,16 +412,16 @@ class AEMBundle(object):
             self.active = False
 
     def do_action(self):
-        aem_request = requests.post(
+        aem_request = self.session.post(
             '%s/system/console/bundles/%s' %
             (self.url, self.name), data={
-                'action': self.action}, auth=(
-                self.admin_user, self.admin_password))
+                'action': self.action})
         if aem_request.status_code != 200:
             self.module.fail_json(
                 msg='failed to perform %s action on %s bundle - %s' %
                 (self.action, aem_request.status_code, aem_request.json()))
         self.changed = True
+        self._invalidate_snapshot()
         self.msg.append(
             'action %s was performmed on bundle %s' %
             (self.action, self.name))
@@ -133,18 +442,521 @@ class AEMBundle(object):
         else:
             self.module.fail_json(msg="can't find bundle '%s'" % (self.name))
 
+    def _snapshot_file(self):
+        return os.path.join(
+            self.cache_dir,
+            hashlib.sha1(self.url.encode('utf-8')).hexdigest() + '.json')
+
+    def _load_snapshot(self):
+        try:
+            with open(self._snapshot_file()) as snapshot_file:
+                return json.load(snapshot_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_snapshot(self, snapshot):
+        _makedirs(self.cache_dir)
+        _write_json(self._snapshot_file(), snapshot)
+
+    def _cached_bundles(self):
+        # bundles of a snapshot younger than cache_ttl, otherwise None
+        if not self.cache_ttl:
+            return None
+        snapshot = self._load_snapshot()
+        if snapshot and time.time() - snapshot['fetched'] < self.cache_ttl:
+            self.result['cached'] = True
+            return snapshot['bundles']
+        return None
+
+    def _store_snapshot(self, data):
+        # replaces the snapshot of the node and diffs it with the old one
+        if not self.cache_ttl:
+            return
+        bundles = [dict((field, bundle.get(field)) for field in SNAPSHOT_FIELDS)
+                   for bundle in data]
+        previous = self._load_snapshot()
+        now = time.time()
+        if previous:
+            self.result['diff'] = self._diff(previous['bundles'], bundles)
+            self.result['diff_seconds'] = round(
+                now - previous.get('taken', previous['fetched']), 3)
+        self._save_snapshot({'url': self.url, 'fetched': now, 'taken': now,
+                             'bundles': bundles})
+
+    def _invalidate_snapshot(self):
+        # keeps the bundles for the next diff, only the age is reset
+        if not self.cache_ttl:
+            return
+        snapshot = self._load_snapshot()
+        if snapshot:
+            snapshot['fetched'] = 0
+            self._save_snapshot(snapshot)
+
+    def _diff(self, old, new):
+        old = dict((bundle['symbolicName'], bundle) for bundle in old)
+        new = dict((bundle['symbolicName'], bundle) for bundle in new)
+        changed = []
+        for name in sorted(set(old) & set(new)):
+            if (old[name]['state'], old[name]['version']) != \
+                    (new[name]['state'], new[name]['version']):
+                changed.append({
+                    'name': name,
+                    'state': [old[name]['state'], new[name]['state']],
+                    'version': [old[name]['version'], new[name]['version']]})
+        return {'added': sorted(set(new) - set(old)),
+                'removed': sorted(set(old) - set(new)),
+                'changed': changed}
+
+    def _get_bundles(self):
+        cached = self._cached_bundles()
+        if cached is not None:
+            return {'data': cached}
+        aem_request = self.session.get('%s/system/console/bundles.json' %
+                                       self.url)
+        if aem_request.status_code != 200:
+            self.module.fail_json(
+                msg='failed to read bundles.json - %s' %
+                aem_request.status_code)
+        status = aem_request.json()
+        self._store_snapshot(status['data'])
+        return status
+
+    def _select(self, bundles):
+        # bundles matching names and name_regex, looked up in an index by
+        # symbolic name. A name without wildcards has to exist
+        index = {}
+        for bundle in bundles:
+            index.setdefault(bundle['symbolicName'], []).append(bundle)
+        regex = re.compile(self.name_regex) if self.name_regex else None
+        selected = set()
+        missing = []
+        for name in self.names:
+            matches = [symbolic_name for symbolic_name in index
+                       if fnmatch.fnmatchcase(symbolic_name, name)]
+            if not matches and not GLOB_CHARS.search(name):
+                missing.append(name)
+            selected.update(matches)
+        if regex:
+            selected.update(symbolic_name for symbolic_name in index
+                            if regex.search(symbolic_name))
+        if missing:
+            self.module.fail_json(msg="can't find bundles '%s'" %
+                                  "', '".join(missing))
+        return [bundle for name in sorted(selected) for bundle in index[name]]
+
+    def _needs_action(self, bundle):
+        # same rules as apply_task, fragments can't be started or stopped
+        if self.action == 'refresh':
+            return True
+        if bundle.get('fragment'):
+            return False
+        if self.action == 'start':
+            return bundle['state'] != 'Active'
+        return bundle['state'] == 'Active'
+
+    def _post_action(self, bundle):
+        # runs in the pool, errors are returned and reported by apply_batch
+        try:
+            aem_request = self.session.post(
+                '%s/system/console/bundles/%s' % (self.url, bundle['id']),
+                data={'action': self.action})
+        except requests.exceptions.RequestException as e:
+            return str(e)
+        if aem_request.status_code != 200:
+            return '%s - %s' % (aem_request.status_code, aem_request.text)
+        return None
+
+    def _map(self, func, items):
+        pool = ThreadPool(max(1, min(self.concurrency, len(items))))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _get_providers(self, bundle):
+        # ids of the bundles this bundle imports packages from
+        aem_request = self.session.get('%s/system/console/bundles/%s.json' %
+                                       (self.url, bundle['id']))
+        if aem_request.status_code != 200:
+            return set()
+        providers = set()
+        for detail in aem_request.json()['data']:
+            for prop in detail.get('props', []):
+                if prop.get('key') != 'Imported Packages':
+                    continue
+                values = prop.get('value')
+                if not isinstance(values, list):
+                    values = [values]
+                for value in values:
+                    providers.update(int(bundle_id) for bundle_id in
+                                     PROVIDER_LINK.findall(str(value)))
+        providers.discard(bundle['id'])
+        return providers
+
+    def _levels(self, bundles, providers):
+        # topological levels, a level only imports from earlier levels.
+        # Bundles in an import cycle end up together in the last level
+        remaining = dict((bundle['id'], bundle) for bundle in bundles)
+        levels = []
+        while remaining:
+            level = [bundle for bundle in remaining.values()
+                     if not providers[bundle['id']] & set(remaining)]
+            if not level:
+                level = list(remaining.values())
+            level.sort(key=lambda bundle: bundle['symbolicName'])
+            levels.append(level)
+            for bundle in level:
+                del remaining[bundle['id']]
+        return levels
+
+    def _refresh_roots(self, levels, providers):
+        # a refresh cascades to the importing bundles, so a bundle that is
+        # reached from an earlier refreshed one needs no refresh of its own
+        importers = {}
+        for bundle_id, bundle_providers in providers.items():
+            for provider in bundle_providers:
+                importers.setdefault(provider, set()).add(bundle_id)
+        covered = set()
+        roots = []
+        for level in levels:
+            for bundle in level:
+                if bundle['id'] in covered:
+                    continue
+                roots.append(bundle)
+                stack = [bundle['id']]
+                while stack:
+                    bundle_id = stack.pop()
+                    if bundle_id not in covered:
+                        covered.add(bundle_id)
+                        stack.extend(importers.get(bundle_id, ()))
+        return roots
+
+    def _apply_ordered(self, pending):
+        # level by level, the next level starts after the whole level is
+        # done and stops at the first failed level
+        providers = dict(zip([bundle['id'] for bundle in pending],
+                             self._map(self._get_providers, pending)))
+        levels = self._levels(pending, providers)
+        if self.action == 'stop':
+            levels.reverse()
+        elif self.action == 'refresh':
+            levels = [[bundle] for bundle in
+                      self._refresh_roots(levels, providers)]
+            self.result['refresh_cycles'] = len(levels)
+        self.result['levels'] = [[bundle['symbolicName'] for bundle in level]
+                                 for level in levels]
+        done = []
+        errors = []
+        for level in levels:
+            done.extend(level)
+            errors.extend(self._map(self._post_action, level))
+            if any(errors):
+                break
+        return done, errors
+
+    def apply_batch(self):
+        selected = self._select(self._get_bundles()['data'])
+        pending = [bundle for bundle in selected if self._needs_action(bundle)]
+        if self.ordered and pending:
+            pending, errors = self._apply_ordered(pending)
+        else:
+            errors = self._map(self._post_action, pending)
+        failed = {}
+        for bundle, error in zip(pending, errors):
+            bundle['action'] = self.action
+            if error:
+                failed[bundle['symbolicName']] = error
+        for bundle in selected:
+            self.bundles.append({'name': bundle['symbolicName'],
+                                 'id': bundle['id'],
+                                 'version': bundle.get('version'),
+                                 'state': bundle['state'],
+                                 'action': bundle.get('action')})
+        done = [bundle['symbolicName'] for bundle in pending
+                if bundle['symbolicName'] not in failed]
+        if done:
+            self.changed = True
+            self._invalidate_snapshot()
+            self.msg.append(
+                'action %s was performmed on bundles %s' %
+                (self.action, ', '.join(done)))
+        if failed:
+            self.module.fail_json(
+                msg='failed to perform %s action on bundles %s' %
+                (self.action, ', '.join(sorted(failed))),
+                errors=failed, bundles=self.bundles)
+
+    def wait_all_active(self):
+        # polls the bundles.json counters, the delay doubles with jitter so
+        # a fleet of nodes doesn't poll in lockstep. Connection errors and
+        # non-200 answers of a restarting instance count as not ready
+        timeout = self.module.params['wait_timeout']
+        delay = max(0.1, self.module.params['poll_interval'])
+        started = time.time()
+        polls = 0
+        counters = {}
+        data = []
+        while True:
+            polls += 1
+            try:
+                aem_request = self.session.get(
+                    '%s/system/console/bundles.json' % self.url)
+                if aem_request.status_code == 200:
+                    status = aem_request.json()
+                    counters = dict(zip(BUNDLE_COUNTERS, status['s']))
+                    data = status['data']
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+            if counters and counters['active'] + counters['fragment'] == counters['total']:
+                break
+            elapsed = time.time() - started
+            if elapsed >= timeout:
+                if data:
+                    self._store_snapshot(data)
+                self.module.fail_json(
+                    msg='bundles are not active after %s seconds' % timeout,
+                    counters=counters, polls=polls,
+                    bundles=[{'name': bundle['symbolicName'],
+                              'state': bundle['state']} for bundle in data
+                             if bundle['state'] not in ['Active', 'Fragment']],
+                    **self.result)
+            time.sleep(min(random.uniform(delay / 2, delay),
+                           timeout - elapsed))
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+        self._store_snapshot(data)
+        self.result.update(counters=counters, polls=polls,
+                           ready_seconds=round(time.time() - started, 3))
+        self.msg.append('all %s bundles are active' % counters['total'])
+
+    def _jar_headers(self, jar_path):
+        # main attributes of META-INF/MANIFEST.MF, continuation lines joined
+        try:
+            with zipfile.ZipFile(jar_path) as jar:
+                manifest = jar.read('META-INF/MANIFEST.MF').decode('utf-8')
+        except (IOError, OSError, KeyError, zipfile.BadZipfile) as e:
+            self.module.fail_json(msg="can't read manifest of %s - %s" %
+                                  (jar_path, e))
+        headers = {}
+        name = None
+        for line in manifest.splitlines():
+            if line.startswith(' ') and name:
+                headers[name] += line[1:]
+            elif ':' in line:
+                name, value = line.split(':', 1)
+                headers[name] = value.strip()
+            elif not line:
+                break
+        if not headers.get('Bundle-SymbolicName'):
+            self.module.fail_json(msg='%s is not a bundle' % jar_path)
+        headers['Bundle-SymbolicName'] = \
+            headers['Bundle-SymbolicName'].split(';')[0].strip()
+        return headers
+
+    def _jar_sha256(self, jar_path):
+        sha256 = hashlib.sha256()
+        with open(jar_path, 'rb') as jar:
+            chunk = jar.read(HASH_CHUNK_SIZE)
+            while chunk:
+                sha256.update(chunk)
+                chunk = jar.read(HASH_CHUNK_SIZE)
+        return sha256.hexdigest()
+
+    def _load_jar_manifest(self):
+        try:
+            with open(self.module.params['jar_manifest']) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            manifest = {}
+        manifest.setdefault('nodes', {})
+        return manifest
+
+    def _save_jar_manifest(self, manifest):
+        # forks on the controller share the manifest, so it is read again
+        # under an exclusive lock and the bundles of this node merged into it
+        manifest_path = self.module.params['jar_manifest']
+        _makedirs(os.path.dirname(manifest_path))
+        with open(manifest_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                saved = self._load_jar_manifest()
+                saved['nodes'].setdefault(self.url, {}).update(
+                    manifest['nodes'].get(self.url, {}))
+                _write_json(manifest_path, saved, indent=2, sort_keys=True)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _install_jar(self, jar):
+        # runs in the pool, the console answers with a redirect to the
+        # bundle list that isn't followed
+        fields = {'action': 'install',
+                  'bundlestartlevel': self.module.params['start_level']}
+        if self.module.params['start']:
+            fields['bundlestart'] = 'start'
+        if self.module.params['refresh_packages']:
+            fields['refreshPackages'] = 'true'
+        body = _MultipartBody('bundlefile', jar['path'], fields)
+        started = time.time()
+        try:
+            aem_request = self.session.post(
+                '%s/system/console/bundles' % self.url, data=body,
+                headers={'Content-Type': body.content_type},
+                allow_redirects=False)
+        except requests.exceptions.RequestException as e:
+            return str(e)
+        jar['bytes'] = len(body)
+        jar['seconds'] = round(time.time() - started, 3)
+        if aem_request.status_code not in [200, 201, 302]:
+            return '%s - %s' % (aem_request.status_code, aem_request.text)
+        return None
+
+    def _bundle_stamp(self, bundle_id):
+        # id and last modification of a bundle, an update of the same
+        # version changes one of them
+        aem_request = self.session.get('%s/system/console/bundles/%s.json' %
+                                       (self.url, bundle_id))
+        if aem_request.status_code != 200:
+            return None
+        details = (aem_request.json().get('data') or [{}])[0]
+        props = dict((prop.get('key'), prop.get('value'))
+                     for prop in details.get('props', [])
+                     if isinstance(prop, dict))
+        return [details.get('id'), props.get('Last Modification')]
+
+    def _replaced(self, jar, stamp, data):
+        # True when the bundle runs the version of the jar and, for an update
+        # of the same version, is no longer the bundle seen before the upload
+        ids = [bundle['id'] for bundle in data
+               if (bundle['symbolicName'], _osgi_version(bundle['version'])) == (jar['name'], jar['version'])]
+        if not ids:
+            return False
+        # without a last modification in the details only the version counts
+        if stamp is None or stamp[1] is None or stamp[0] not in ids:
+            return True
+        return self._bundle_stamp(stamp[0]) != stamp
+
+    def _wait_versions(self, jars, stamps=None):
+        # the console installs in the background, so bundles.json is polled
+        # until every bundle runs the uploaded version
+        stamps = stamps or {}
+        timeout = self.module.params['wait_timeout']
+        delay = max(0.1, self.module.params['poll_interval'])
+        started = time.time()
+        waiting = list(jars)
+        while True:
+            aem_request = self.session.get('%s/system/console/bundles.json' %
+                                           self.url)
+            if aem_request.status_code == 200:
+                data = aem_request.json()['data']
+                waiting = [jar for jar in waiting if not self._replaced(
+                    jar, stamps.get(jar['path']), data)]
+                if not waiting:
+                    self._store_snapshot(data)
+                    return []
+            elapsed = time.time() - started
+            if elapsed >= timeout:
+                return waiting
+            time.sleep(min(random.uniform(delay / 2, delay),
+                           timeout - elapsed))
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+
+    def install_jars(self):
+        index = dict((bundle['symbolicName'], bundle)
+                     for bundle in self._get_bundles()['data'])
+        manifest = self._load_jar_manifest()
+        installed = manifest['nodes'].setdefault(self.url, {})
+        jars = []
+        for jar_path in self.jars:
+            headers = self._jar_headers(jar_path)
+            jar = {'path': jar_path,
+                   'name': headers['Bundle-SymbolicName'],
+                   'version': _osgi_version(
+                       headers.get('Bundle-Version', '0.0.0')),
+                   'sha256': self._jar_sha256(jar_path)}
+            running = index.get(jar['name'])
+            recorded = installed.get(jar['name'])
+            if running is None:
+                jar['action'] = 'install'
+            elif _osgi_version(running['version']) != jar['version']:
+                jar['action'] = 'update'
+            elif recorded and recorded['sha256'] == jar['sha256']:
+                jar['action'] = None
+            elif recorded or jar['version'].endswith('SNAPSHOT'):
+                jar['action'] = 'update'
+            else:
+                jar['action'] = None
+            jars.append(jar)
+        pending = [jar for jar in jars if jar['action']]
+        # the running bundle already has the version of a same-version
+        # update, its id and last modification tell when it was replaced
+        stamps = {}
+        for jar in pending:
+            running = index.get(jar['name'])
+            if running and _osgi_version(running['version']) == jar['version']:
+                stamps[jar['path']] = self._bundle_stamp(running['id'])
+        errors = self._map(self._install_jar, pending)
+        failed = dict((jar['path'], error)
+                      for jar, error in zip(pending, errors) if error)
+        uploaded = [jar for jar in pending if jar['path'] not in failed]
+        if uploaded:
+            self.changed = True
+            self._invalidate_snapshot()
+            for jar in self._wait_versions(uploaded, stamps):
+                if jar['path'] in stamps:
+                    failed[jar['path']] = 'version %s was not replaced' % \
+                        jar['version']
+                else:
+                    failed[jar['path']] = 'version %s is not running' % \
+                        jar['version']
+        for jar in uploaded:
+            if jar['path'] not in failed:
+                installed[jar['name']] = {'version': jar['version'],
+                                          'sha256': jar['sha256']}
+        self._save_jar_manifest(manifest)
+        self.result['jars'] = jars
+        done = [jar['name'] for jar in uploaded if jar['path'] not in failed]
+        if done:
+            self.msg.append('bundles %s were installed' % ', '.join(done))
+        if failed:
+            self.module.fail_json(
+                msg='failed to install %s' % ', '.join(sorted(failed)),
+                errors=failed, **self.result)
+
     def show_message(self):
+        result = dict(self.result, timings=self.timings.summary())
+        if self.state == 'all_active':
+            self.module.exit_json(changed=False, msg=','.join(self.msg),
+                                  **result)
+        if self.names or self.name_regex:
+            result['bundles'] = self.bundles
         if self.changed:
             msg = ','.join(self.msg)
-            self.module.exit_json(changed=True, msg=msg)
+            self.module.exit_json(changed=True, msg=msg, **result)
         else:
-            self.module.exit_json(changed=False)
+            self.module.exit_json(changed=False, **result)
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            name=dict(required=True, type='str'),
+            name=dict(required=False, type='str'),
+            names=dict(required=False, type='list'),
+            name_regex=dict(required=False, type='str'),
+            concurrency=dict(default=4, type='int'),
+            ordered=dict(default=False, type='bool'),
+            state=dict(required=False, type='str',
+                       choices=['all_active', 'installed']),
+            jars=dict(required=False, type='list'),
+            start=dict(default=True, type='bool'),
+            start_level=dict(default=20, type='int'),
+            refresh_packages=dict(default=True, type='bool'),
+            jar_manifest=dict(default='~/.ansible/aem_bundle_manifest.json',
+                              type='path'),
+            wait_timeout=dict(default=600, type='int'),
+            poll_interval=dict(default=1, type='float'),
+            cache_ttl=dict(default=0, type='int'),
+            cache_dir=dict(default='~/.ansible/tmp/aem_bundle', type='path'),
+            timings_file=dict(required=False, type='path'),
             action=dict(
                 default='start',
                 type='str',
@@ -156,11 +968,21 @@ def main():
             admin_password=dict(required=True, type='str', no_log=True),
             url=dict(required=True, type='str')
         ),
+        required_one_of=[['name', 'names', 'name_regex', 'state']],
+        mutually_exclusive=[['name', 'names'], ['name', 'name_regex']],
+        required_if=[['state', 'installed', ['jars']]],
         supports_check_mode=False
     )
 
     bundle = AEMBundle(module)
-    bundle.apply_task()
+    if bundle.state == 'all_active':
+        bundle.wait_all_active()
+    elif bundle.state == 'installed':
+        bundle.install_jars()
+    elif bundle.names or bundle.name_regex:
+        bundle.apply_batch()
+    else:
+        bundle.apply_task()
     bundle.show_message()
 
 
@@ -6,9 +6,28 @@
 # https://www.gnu.org/licenses/gpl-3.0.txt)
 
 
+import email.utils
+import fcntl
+import hashlib
 import json
+import os
+import re
+import tempfile
+import time
+import uuid
+import threading
+import zipfile
 import xml.etree.ElementTree as ET
+from collections import deque
+from xml.parsers import expat
+from multiprocessing.pool import ThreadPool
 import requests
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+from requests.compat import urlparse
+from requests.packages.urllib3.util.retry import Retry
 from ansible.module_utils.basic import *
 
 __version__ = '1.0.0'
@@ -21,8 +40,62 @@ author:
 short_description: Manage AEM packages
 description:
   - Manage AEM packages
+  - state pruned needs prune_pattern or prune_groups. Packages in the
+    adobe and day groups (product, service pack and hotfix packages) are
+    only pruned when their group is listed in prune_groups
 '''
 EXAMPLES = '''
+# A package is considered present when a package with the group, name and
+# version from META-INF/vault/properties.xml of pkg_path is listed in AEM,
+# pkg_name defaults to the name from the package properties.
+# Set pkg_identity_check: false to look up pkg_name instead.
+
+# Build a package on AEM and download it, an existing file is replaced
+# only with aem_force:
+
+    - aem_packmgr:
+        state: downloaded
+        pkg_name: content-backup
+        pkg_group: backups
+        pkg_build: true
+        pkg_path: /var/backups/aem/
+        aem_force: true
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Deploy one package to several nodes at once, the zip is read once and
+# streamed to up to pkg_concurrency nodes in parallel:
+
+    - aem_packmgr:
+        state: present
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        pkg_concurrency: 14
+        aem_user: admin
+        aem_passwd: admin
+        aem_urls:
+          - http://auth01:4502
+          - http://auth02:4502
+          - http://publ01:4503
+          - http://publ02:4503
+
+# Remove old versions of snapshot packages (prune_pattern is matched
+# against the download name), the two newest versions of every package
+# and the version installed last are kept. prune_pattern or prune_groups
+# is required, adobe/* and day/* packages are left alone unless their
+# group is listed in prune_groups:
+
+    - aem_packmgr:
+        state: pruned
+        prune_keep: 2
+        prune_older_than: 30
+        prune_pattern: 'SNAPSHOT'
+        prune_groups:
+          - my_packages
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
 # Remove package :
     - aem_packmgr:
         state: absent
@@ -54,24 +127,510 @@ EXAMPLES = '''
         aem_passwd: admin
         aem_url: http://auth01:4502
 
+# Validate and install a package with a single upload, the package is
+# validated on the server by name after it was uploaded:
+
+    - aem_packmgr:
+        state: present
+        pkg_name: test-all
+        pkg_validate: true
+        pkg_upload_once: true
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Skip upload and installation if exactly the same file was already
+# installed on this node, even when forced:
+
+    - aem_packmgr:
+        state: present
+        pkg_name: test-all
+        aem_force: true
+        pkg_checksum_skip: true
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Every HTTP call is returned in timings (method, path, status, bytes and
+# seconds until the response headers), aem_timings_file also appends the
+# calls as JSON lines to a local file:
+
+    - aem_packmgr:
+        state: present
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_timings_file: /tmp/aem_timings.jsonl
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Reuse the package listing of the node for 5 minutes, so many
+# aem_packmgr tasks in one play fetch it only once:
+
+    - aem_packmgr:
+        state: present
+        pkg_name: test-all
+        pkg_list_cache_ttl: 300
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Deploy several packages, uploads run in parallel and packages are
+# installed one by one in the declared order:
+
+    - aem_packmgr:
+        state: present
+        pkg_concurrency: 4
+        packages:
+          - name: test-core
+            path: /home/vagrant/test-core-2.2-SNAPSHOT.zip
+          - name: test-content
+            path: /home/vagrant/test-content-2.2-SNAPSHOT.zip
+            after: [test-config]
+          - name: test-config
+            path: /home/vagrant/test-config-2.2-SNAPSHOT.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Upload a large package over an unreliable link in 64 MB chunks to
+# /etc/packages/<group>/<name>-<version>.zip from the package properties,
+# pkg_group is used for zips without them. A failed chunk is retried with
+# exponential backoff and the upload resumes where it stopped:
+
+    - aem_packmgr:
+        state: present
+        pkg_name: test-all
+        pkg_chunk_size: 64
+        pkg_group: my_packages
+        pkg_retries: 5
+        pkg_retry_backoff: 2
+        pkg_connect_timeout: 30
+        pkg_read_timeout: 600
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
+# Install a huge package without keeping one request open for the whole
+# installation, the package status is polled every 15 seconds:
+
+    - aem_packmgr:
+        state: present
+        pkg_name: test-all
+        pkg_install_async: true
+        pkg_poll_interval: 15
+        pkg_install_timeout: 7200
+        pkg_path: /home/vagrant/test-all-2.2-SNAPSHOT.zip
+        aem_user: admin
+        aem_passwd: admin
+        aem_url: http://auth01:4502
+
 '''
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+FANOUT_READ_AHEAD = 8
+RETRY_STATUSES = (502, 503, 504)
+# service.jsp replies are parsed while they are read, only the last
+# LOG_TAIL_LINES lines of an install log and its error lines are kept
+RESPONSE_READ_SIZE = 64 * 1024
+LOG_TAIL_LINES = 20
+LOG_ERROR_LINE = re.compile(r'^E |Exception|\bERROR\b')
+# groups of product packages, pruned only when listed in prune_groups
+PROTECTED_GROUPS = ['adobe', 'day']
+TRANSFER_DEFAULTS = {'retries': 0, 'backoff': 0, 'chunk_size': 0,
+                     'group': 'my_packages'}
+
+
+class _TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter with a default timeout for every request"""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(_TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(_TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def _aem_session(login, password, pool_size=1, timeout=None, retries=0,
+                 backoff=0):
+    # one keep-alive session per task, sized for the concurrent uploads.
+    # urllib3 retries idempotent requests only, uploads are retried by
+    # _pkg_upload and _pkg_upload_chunked
+    session = requests.Session()
+    session.auth = (login, password)
+    adapter = _TimeoutHTTPAdapter(
+        timeout=timeout, pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=backoff,
+                          status_forcelist=RETRY_STATUSES,
+                          raise_on_status=False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _no_read_timeout(session, url):
+    # install, build and validation run as long as AEM needs, only the
+    # connect timeout of the session applies to them
+    timeout = getattr(session.get_adapter(url), 'timeout', None)
+    if isinstance(timeout, tuple):
+        timeout = timeout[0]
+    return (timeout, None)
+
+
+def _retry_wait(transfer, attempt):
+    # exponential backoff, attempt counts from 1
+    if attempt > transfer['retries']:
+        return False
+    time.sleep(transfer['backoff'] * 2 ** (attempt - 1))
+    return True
+
+
+class _Timings(object):
+    """method, path, status, bytes and latency of every HTTP call of a
+    session, recorded by its response hook"""
+
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def hook(self, response, *args, **kwargs):
+        # runs before the body is read, so bytes_in is the Content-Length
+        # and seconds is the time until the response headers arrived
+        url = urlparse(response.request.url)
+        call = {'method': response.request.method,
+                'path': url.path + ('?' + url.query if url.query else ''),
+                'status': response.status_code,
+                'bytes_out': int(response.request.headers.get(
+                    'Content-Length') or 0),
+                'bytes_in': int(response.headers.get('Content-Length') or 0),
+                'seconds': round(response.elapsed.total_seconds(), 3)}
+        with self.lock:
+            self.calls.append(call)
+            if self.log_file:
+                with open(self.log_file, 'a') as log_file:
+                    log_file.write(json.dumps(dict(
+                        call, time=round(time.time(), 3),
+                        url='%s://%s' % (url.scheme, url.netloc))) + '\n')
+
+    def summary(self):
+        with self.lock:
+            return {'requests': len(self.calls),
+                    'seconds': round(sum(call['seconds']
+                                         for call in self.calls), 3),
+                    'bytes_out': sum(call['bytes_out'] for call in self.calls),
+                    'bytes_in': sum(call['bytes_in'] for call in self.calls),
+                    'calls': list(self.calls)}
+
+
+class _MultipartBody(object):
+    """multipart/form-data body streamed from disk in fixed-size chunks"""
+
+    def __init__(self, file_name, file_path, fields=None,
+                 chunk_size=UPLOAD_CHUNK_SIZE, source=None):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.source = source
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+
+        head = []
+        for key, value in (fields or {}).items():
+            head.append('--%s\r\nContent-Disposition: form-data; name="%s"'
+                        '\r\n\r\n%s\r\n' % (boundary, key, value))
+        head.append('--%s\r\nContent-Disposition: form-data; name="file"; '
+                    'filename="%s"\r\nContent-Type: application/zip\r\n\r\n'
+                    % (boundary, file_name))
+        self.head = ''.join(head).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self.file_size = os.path.getsize(file_path)
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        if self.source is not None:
+            for chunk in self.source:
+                yield chunk
+            yield self.tail
+            return
+        with open(self.file_path, 'rb') as package:
+            chunk = package.read(self.chunk_size)
+            while chunk:
+                yield chunk
+                chunk = package.read(self.chunk_size)
+        yield self.tail
+
+
+class _FanOut(object):
+    """reads a file once and hands every chunk to several uploads"""
+
+    def __init__(self, file_path, consumers, chunk_size=UPLOAD_CHUNK_SIZE,
+                 read_ahead=FANOUT_READ_AHEAD):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.queues = [Queue(read_ahead) for number in range(consumers)]
+        self.closed = [False] * consumers
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def source(self, number):
+        chunk = self.queues[number].get()
+        while chunk is not None:
+            yield chunk
+            chunk = self.queues[number].get()
+
+    def close(self, number):
+        # a failed upload stops consuming, the reader must not wait for it
+        self.closed[number] = True
+
+    def _put(self, number, chunk):
+        while not self.closed[number]:
+            try:
+                self.queues[number].put(chunk, timeout=1)
+                return
+            except Full:
+                pass
+
+    def _read(self):
+        # the slowest upload sets the pace, at most read_ahead chunks are
+        # buffered for any of them
+        with open(self.file_path, 'rb') as package:
+            chunk = package.read(self.chunk_size)
+            while chunk and not all(self.closed):
+                for number in range(len(self.queues)):
+                    self._put(number, chunk)
+                chunk = package.read(self.chunk_size)
+        for number in range(len(self.queues)):
+            self._put(number, None)
+
+
+def _pkg_upload(url, session, file_name, file_path, fields=None,
+                query='', uploads=None, transfer=None, source=None):
+    # the body is an iterable with a known length, so requests sends it with
+    # Content-Length and never holds more than one chunk of the package.
+    # Every iteration reopens the file, so a retry just sends it again
+    transfer = transfer or TRANSFER_DEFAULTS
+    body = _MultipartBody(file_name, file_path, fields, source=source)
+    started = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = session.post(
+                url + '/crx/packmgr/service.jsp' + query, data=body,
+                headers={'Content-Type': body.content_type}, stream=True)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if not _retry_wait(transfer, attempt):
+                raise
+            continue
+        if response.status_code not in RETRY_STATUSES or \
+                not _retry_wait(transfer, attempt):
+            break
+        response.close()
+    elapsed = time.time() - started
+    if uploads is not None:
+        uploads.append(_upload_stats(file_name, len(body), elapsed))
+    return response
+
+
+def _pkg_chunk_offset(session, file_url, size):
+    # bytes of an interrupted chunked upload already stored by Sling
+    response = session.get(file_url + '.1.json')
+    if response.status_code != 200:
+        return 0
+    node = response.json()
+    for props in (node, node.get('jcr:content') or {}):
+        if props.get('sling:fileLength') == size and 'sling:length' in props:
+            return props['sling:length']
+    return 0
+
+
+def _pkg_upload_chunked(url, session, file_path, transfer, uploads=None):
+    # Sling chunked upload into /etc/packages/<group>, every chunk is a
+    # separate request and a failed chunk resumes from the offset that the
+    # server reports, not from the start of the file
+    # the package is stored where package manager keeps it, under the group
+    # and name of its properties
+    identity = _pkg_properties(file_path)
+    if identity and identity.get('group') and identity.get('name'):
+        group = identity['group']
+        file_name = identity['name']
+        if identity.get('version'):
+            file_name += '-' + identity['version']
+        file_name += '.zip'
+    else:
+        identity = None
+        group = transfer['group']
+        file_name = os.path.basename(file_path)
+    folder_url = url + '/etc/packages/' + group
+    size = os.path.getsize(file_path)
+    # offset is None until the server reported it, a failed query of the
+    # offset is retried like a failed chunk
+    offset = None
+    sent = 0
+    attempt = 0
+    started = time.time()
+    with open(file_path, 'rb') as package:
+        while offset is None or offset < size:
+            if offset is None:
+                try:
+                    offset = _pkg_chunk_offset(
+                        session, folder_url + '/' + file_name, size)
+                    continue
+                except requests.exceptions.RequestException:
+                    pass
+            else:
+                package.seek(offset)
+                chunk = package.read(transfer['chunk_size'])
+                fields = {file_name + '@Offset': offset,
+                          file_name + '@Length': size}
+                if offset + len(chunk) >= size:
+                    fields[file_name + '@Completed'] = 'true'
+                try:
+                    response = session.post(
+                        folder_url, data=fields,
+                        files={file_name: (file_name, chunk,
+                                           'application/zip')})
+                    stored = 200 <= response.status_code < 300
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout):
+                    stored = False
+                sent += len(chunk)
+                if stored:
+                    offset += len(chunk)
+                    attempt = 0
+                    continue
+            attempt += 1
+            if not _retry_wait(transfer, attempt):
+                print('chunked upload of ' + file_name + ' is failed')
+                return None
+            offset = None
+    if uploads is not None:
+        uploads.append(_upload_stats(file_name, sent, time.time() - started))
+
+    index = _pkg_index(_pkg_list(url, session))
+    if identity:
+        return _pkg_find(index, identity['group'], identity['name'],
+                         identity['version'])
+    matches = index['downloadName'].get(file_name, [])
+    for package in matches:
+        if package.get('group') == group:
+            return package
+    return matches[0] if matches else None
+
+
+def _upload_stats(file_name, size, elapsed):
+    if elapsed > 0:
+        throughput = round(size / elapsed / 1024 / 1024, 2)
+    else:
+        throughput = None
+    return {'name': file_name, 'bytes': size, 'seconds': round(elapsed, 3),
+            'mb_per_sec': throughput}
+
+
+def _pkg_list_fetch(url, session, etag=None):
+    # the listing is parsed while it is downloaded, every package element is
+    # released as soon as its properties are copied
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    response = session.get(url + '/crx/packmgr/service.jsp?cmd=ls',
+                           headers=headers, stream=True)
+    if response.status_code == 304:
+        response.close()
+        return None, etag
+    response.raw.decode_content = True
+    packages = []
+    for event, element in ET.iterparse(response.raw):
+        if element.tag == 'package':
+            packages.append(dict((child.tag, child.text)
+                                 for child in element))
+            element.clear()
+    response.close()
+    return packages, response.headers.get('ETag')
+
+
+def _pkg_list_cache_file(url, cache):
+    return os.path.join(cache['dir'],
+                        hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def _pkg_list(url, session, cache=None):
+    if not cache or not cache.get('ttl'):
+        return _pkg_list_fetch(url, session)[0]
+
+    cache_file = _pkg_list_cache_file(url, cache)
+    try:
+        with open(cache_file) as listing_file:
+            cached = json.load(listing_file)
+    except (IOError, OSError, ValueError):
+        cached = None
+    if cached and time.time() - cached['fetched'] < cache['ttl']:
+        return cached['packages']
+
+    packages, etag = _pkg_list_fetch(url, session,
+                                     cached and cached.get('etag'))
+    if packages is None:
+        packages = cached['packages']
+    _makedirs(cache['dir'])
+    _write_json(cache_file, {'url': url, 'etag': etag, 'fetched': time.time(),
+                             'packages': packages})
+    return packages
+
+
+def _pkg_list_index(url, session, cache=None):
+    # the listing of a URL is fetched and indexed once per task and kept
+    # in memory until _pkg_list_invalidate drops it after a change
+    if cache is None:
+        return _pkg_index(_pkg_list(url, session))
+    with cache['lock']:
+        index = cache['indexes'].get(url)
+    if index is None:
+        index = _pkg_index(_pkg_list(url, session, cache))
+        with cache['lock']:
+            cache['indexes'][url] = index
+    return index
+
+
+def _pkg_list_invalidate(url, cache=None):
+    if not cache:
+        return
+    with cache['lock']:
+        cache['indexes'].pop(url, None)
+    if not cache.get('ttl'):
+        return
+    try:
+        os.remove(_pkg_list_cache_file(url, cache))
+    except OSError:
+        pass
+
 
-def _pgk_exist(url, login, password, int_pkg_name):
-    response = requests.get(url + '/crx/packmgr/service.jsp?cmd=ls',
-                            auth=(login, password))
-    aem_response = ET.fromstring(response.text)
+def _pkg_index(packages):
+    index = {'name': {}, 'group': {}, 'downloadName': {}, 'version': {}}
+    for package in packages:
+        for key, values in index.items():
+            values.setdefault(package.get(key), []).append(package)
+    return index
 
-    packages_list = []
-    for package in aem_response.findall('response/data/packages/package/name'):
-        packages_list.append(package.text)
 
-    download_names = []
-    for elements in aem_response.findall(
-            'response/data/packages/package/downloadName'):
-        download_names.append(elements.text)
+def _pgk_exist(url, session, int_pkg_name, cache=None):
+    index = _pkg_list_index(url, session, cache)
 
-    if any(int_pkg_name in x for x in (packages_list, download_names)):
+    if int_pkg_name in index['name'] or int_pkg_name in index['downloadName']:
         print('installed')
         return True
     else:
@@ -79,62 +638,447 @@ def _pgk_exist(url, login, password, int_pkg_name):
         return False
 
 
-def _pkg_validate(url, login, password, file_name, file_path):
-    # validation
-    file = {'file': (file_name, open(file_path, 'rb'), 'application/zip')}
-    response = requests.post(
-        url + '/crx/packmgr/service.jsp?cmd=validate&type=osgiPackageI\
-        mports,overlays,acls', files=file, auth=(login, password))
-    print(response.text)
-    aem_response = ET.fromstring(response.text)
-    if (aem_response.find("response/status").attrib['code']) == '200':
+def _pkg_find(index, group, name, version):
+    for package in index['name'].get(name, []):
+        if package.get('group') != group:
+            continue
+        if (package.get('version') or '') == (version or ''):
+            return package
+    return None
+
+
+def _file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as package:
+        chunk = package.read(HASH_CHUNK_SIZE)
+        while chunk:
+            sha256.update(chunk)
+            chunk = package.read(HASH_CHUNK_SIZE)
+    return sha256.hexdigest()
+
+
+def _manifest_load(manifest_path):
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, OSError, ValueError):
+        manifest = {}
+    manifest.setdefault('files', {})
+    manifest.setdefault('nodes', {})
+    return manifest
+
+
+def _manifest_save(manifest_path, manifest):
+    # forks on the controller share the manifest, so it is read again under
+    # an exclusive lock and the entries of this run are merged into it
+    manifest_dir = os.path.dirname(manifest_path)
+    _makedirs(manifest_dir)
+    with open(manifest_path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            saved = _manifest_load(manifest_path)
+            saved['files'].update(manifest['files'])
+            for url, records in manifest['nodes'].items():
+                saved['nodes'].setdefault(url, {}).update(records)
+            _write_json(manifest_path, saved, indent=2, sort_keys=True)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _makedirs(path):
+    # another fork may create the directory at the same time
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def _write_json(path, data, **kwargs):
+    # every writer gets its own temp file next to path, the rename replaces
+    # path atomically
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.', suffix='.tmp',
+        dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(tmp_fd, 'w') as tmp_file:
+            json.dump(data, tmp_file, **kwargs)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _pkg_checksum(manifest, file_path):
+    # the hash of an unchanged file (same size and mtime) is taken from the
+    # manifest, so repeated runs don't re-read multi-GB packages
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    cached = manifest['files'].get(file_path)
+    if cached and cached['size'] == stat.st_size and \
+            cached['mtime'] == stat.st_mtime:
+        return cached['sha256']
+    sha256 = _file_sha256(file_path)
+    manifest['files'][file_path] = {'size': stat.st_size,
+                                    'mtime': stat.st_mtime,
+                                    'sha256': sha256}
+    return sha256
+
+
+def _pkg_properties(file_path):
+    # zipfile seeks to the central directory and reads only the two vault
+    # entries, the package content itself is never touched
+    if not zipfile.is_zipfile(file_path):
+        return None
+    with zipfile.ZipFile(file_path) as archive:
+        names = set(archive.namelist())
+        if 'META-INF/vault/properties.xml' not in names:
+            return None
+        properties = ET.fromstring(
+            archive.read('META-INF/vault/properties.xml'))
+        workspace_filter = None
+        if 'META-INF/vault/filter.xml' in names:
+            workspace_filter = ET.fromstring(
+                archive.read('META-INF/vault/filter.xml'))
+
+    entries = dict((entry.get('key'), entry.text)
+                   for entry in properties.findall('entry'))
+    identity = {'group': entries.get('group'), 'name': entries.get('name'),
+                'version': entries.get('version'), 'filters': []}
+    if workspace_filter is not None:
+        identity['filters'] = [element.get('root') for element in
+                               workspace_filter.findall('filter')]
+    return identity
+
+
+def _pkg_identity_exist(url, session, identity, cache=None):
+    index = _pkg_list_index(url, session, cache)
+    if _pkg_find(index, identity['group'], identity['name'],
+                 identity['version']) is not None:
+        print('installed')
         return True
     else:
+        print('not installed')
         return False
 
 
-def _pkg_install(url, login, password, file_name, file_path, install=False,
-                 strict=True):
-    # uploading
-    files = {'file': (file_name, open(file_path, 'rb'), 'application/zip')}
+def _pkg_same_installed(url, session, manifest, sha256, cache=None):
+    recorded = manifest['nodes'].get(url, {}).get(sha256)
+    if not recorded or not recorded.get('lastUnpacked'):
+        return False
+    package = _pkg_find(_pkg_list_index(url, session, cache),
+                        recorded['group'], recorded['name'],
+                        recorded['version'])
+    return package is not None and \
+        package.get('lastUnpacked') == recorded['lastUnpacked']
+
+
+def _pkg_record(url, session, manifest, sha256, uploaded, cache=None):
+    package = _pkg_find(_pkg_list_index(url, session, cache),
+                        uploaded.get('group'), uploaded.get('name'),
+                        uploaded.get('version'))
+    if package is None:
+        return
+    manifest['nodes'].setdefault(url, {})[sha256] = {
+        'group': package.get('group'),
+        'name': package.get('name'),
+        'version': package.get('version'),
+        'lastUnpacked': package.get('lastUnpacked')}
+
+
+class _PackMgrResponse(object):
+    """status, package and install log of a service.jsp reply, built by an
+    expat parser that is fed the body chunk by chunk"""
+
+    def __init__(self, log_tail=LOG_TAIL_LINES):
+        self.code = None
+        self.status = None
+        self.package = None
+        self.log = deque(maxlen=log_tail)
+        self.errors = deque(maxlen=log_tail)
+        self._path = []
+        self._text = []
+        self._line = ''
+        self._parser = expat.ParserCreate()
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+    @property
+    def ok(self):
+        return self.code == '200'
+
+    def feed(self, data, final=False):
+        self._parser.Parse(data, final)
+
+    def message(self):
+        # the status text plus the lines that explain a failure
+        lines = list(self.errors) or list(self.log)
+        return '\n'.join([self.status or ''] + lines).strip()
+
+    def _start(self, tag, attrs):
+        self._path.append(tag)
+        self._text = []
+        if self._path[-2:] == ['response', 'status']:
+            self.code = attrs.get('code')
+        elif self._path[-3:] == ['response', 'data', 'package']:
+            self.package = {}
+
+    def _data(self, data):
+        if self._path[-1:] != ['log']:
+            self._text.append(data)
+            return
+        lines = (self._line + data).split('\n')
+        self._line = lines.pop()
+        for line in lines:
+            self._log_line(line)
+
+    def _log_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        self.log.append(line)
+        if LOG_ERROR_LINE.search(line):
+            self.errors.append(line)
+
+    def _end(self, tag):
+        text = ''.join(self._text)
+        if self._path[-1:] == ['log']:
+            self._log_line(self._line)
+            self._line = ''
+        elif self._path[-2:] == ['response', 'status']:
+            self.status = text.strip()
+        elif self.package is not None and \
+                self._path[-4:-1] == ['response', 'data', 'package']:
+            self.package[tag] = text or None
+        self._path.pop()
+        self._text = []
+
+
+def _pkg_response(response, log_tail=LOG_TAIL_LINES):
+    # parses a service.jsp reply from the raw stream. Parsing stops at
+    # response/status, the rest is only drained so the connection goes
+    # back to the pool
+    parsed = _PackMgrResponse(log_tail)
+    try:
+        chunks = response.iter_content(RESPONSE_READ_SIZE)
+        for chunk in chunks:
+            parsed.feed(chunk)
+            if parsed.status is not None:
+                break
+        for chunk in chunks:
+            pass
+    except expat.ExpatError:
+        parsed.code = None
+        parsed.status = None
+    finally:
+        response.close()
+    if parsed.status is None:
+        parsed.code = None
+        parsed.status = 'HTTP %d without package manager status' \
+            % response.status_code
+    return parsed
+
+
+def _pkg_validate(url, session, file_name, file_path, uploads=None,
+                  transfer=None):
+    # validation
+    response = _pkg_response(_pkg_upload(
+        url, session, file_name, file_path,
+        query='?cmd=validate&type=osgiPackageImports,overlays,acls',
+        uploads=uploads, transfer=transfer))
+    print(response.message())
+    return response.ok
+
+
+def _pkg_validate_uploaded(url, session, int_pkg_name):
+    # validation of a package that is already uploaded, no second transfer
+    response = _pkg_response(session.post(
+        url + '/crx/packmgr/service.jsp?cmd=validate&type=osgiPackageImports,'
+        'overlays,acls&name=' + int_pkg_name,
+        timeout=_no_read_timeout(session, url), stream=True))
+    print(response.message())
+    return response.ok
+
+
+def _pkg_upload_only(url, session, file_name, file_path, install=False,
+                     strict=True, uploads=None, transfer=None, source=None):
+    # uploading, returns properties of the uploaded package or None
+    if transfer and transfer['chunk_size']:
+        return _pkg_upload_chunked(url, session, file_path, transfer, uploads)
     values = {'install': install, 'strict': strict}
-    response = requests.post(url + '/crx/packmgr/service.jsp', files=files,
-                             data=values, auth=(login, password))
-    aem_response = ET.fromstring(response.text)
+    response = _pkg_response(_pkg_upload(
+        url, session, file_name, file_path, fields=values, uploads=uploads,
+        transfer=transfer, source=source))
     print('uload finished')
-    if (aem_response.find("response/status").attrib['code']) == '200':
-        print(response.text)
-        int_pkg_name = aem_response.find("response/data/package/name").text
-        print("testing result")
-        install_status = requests.post(
+    if response.ok and response.package is not None:
+        print('uploaded ' + response.package.get('name', file_name))
+        return response.package
+    else:
+        print(response.message())
+        return None
+
+
+def _pkg_node_path(package):
+    path = '/etc/packages/'
+    if package.get('group'):
+        path += package['group'] + '/'
+    return path + package['downloadName']
+
+
+def _pkg_definition_url(url, package):
+    return url + _pkg_node_path(package) + '/jcr:content/vlt:definition.json'
+
+
+def _pkg_poll(session, url):
+    # AEM may answer a poll with an error page or drop the connection while
+    # the install restarts bundles, the error is returned instead of raised
+    try:
+        response = session.get(url)
+        if response.status_code != 200:
+            return None, '%s - %s' % (url, response.status_code)
+        status = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return None, '%s - %s' % (url, e)
+    if not isinstance(status, dict):
+        return None, '%s - unexpected response' % url
+    return status, None
+
+
+def _pkg_last_unpacked(url, session, package):
+    definition, error = _pkg_poll(session, _pkg_definition_url(url, package))
+    return (definition or {}).get('lastUnpacked'), error
+
+
+def _pkg_inst_async(url, session, package, inst_opts, installs=None):
+    # cmd=inst keeps running in AEM after the client stops waiting for the
+    # response, so the request is only given poll_interval seconds and the
+    # package definition is polled until lastUnpacked changes
+    int_pkg_name = package['name']
+    before = _pkg_last_unpacked(url, session, package)[0]
+    connect_timeout = _no_read_timeout(session, url)[0]
+    started = time.time()
+    progress = []
+    response = None
+    try:
+        response = session.post(
             url + '/crx/packmgr/service.jsp?cmd=inst&name=' + int_pkg_name,
-            auth=(login, password))
-        aem_inst_response = ET.fromstring(install_status.text)
-        # if failure aem send status code 500 with responce status 200
-        if (aem_inst_response.find("response/status").attrib['code']) == '200':
-            print('ok')
-            return True
-        else:
-            print(json.dumps({
-                "failed": True,
-                "msg": install_status.text
-            }))
-            _pkg_remove(url, login, password, int_pkg_name)
-            return False
+            timeout=(connect_timeout, inst_opts['poll_interval']),
+            stream=True)
+        install_status = _pkg_response(response)
+    except requests.exceptions.ReadTimeout:
+        install_status = None
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError):
+        # the headers came in time but the install log stalled, reading
+        # the body timed out
+        if response is None:
+            raise
+        install_status = None
+
+    installed = False
+    last_error = None
+    if install_status is not None:
+        installed = install_status.ok
     else:
-        print(json.dumps({
-            "failed": True,
-            "msg": response.text
-        }))
+        # a poll that fails counts as still running until the timeout
+        running = False
+        while time.time() - started < inst_opts['timeout']:
+            time.sleep(inst_opts['poll_interval'])
+            status, error = _pkg_poll(session, url + '/crx/packmgr/installstatus.jsp')
+            if status is not None:
+                status = status.get('status')
+                status = status if isinstance(status, dict) else {}
+                running = running or not status.get('finished', True)
+                progress.append({'seconds': round(time.time() - started, 1),
+                                 'items': status.get('itemCount')})
+            else:
+                status, last_error = {}, error
+            last_unpacked, error = _pkg_last_unpacked(url, session, package)
+            last_error = error or last_error
+            if last_unpacked and last_unpacked != before:
+                installed = True
+                break
+            if running and status.get('finished'):
+                # installer stopped without unpacking the package
+                break
+
+    if installs is not None:
+        installs.append({'name': int_pkg_name,
+                         'seconds': round(time.time() - started, 3),
+                         'progress': progress})
+        if install_status is not None and not installed:
+            installs[-1]['log'] = install_status.message().splitlines()
+        if last_error and not installed:
+            installs[-1]['error'] = last_error
+    if installed:
+        print('ok')
+        return True
+    if install_status is None:
+        # AEM may still be installing the package, it is left in place
+        print("installation of %s did not finish" % int_pkg_name)
+        if last_error:
+            print('last poll failed: %s' % last_error)
         return False
+    print(install_status.message())
+    _pkg_remove(url, session, int_pkg_name)
+    return False
+
+
+def _pkg_inst(url, session, package, inst_opts=None, installs=None):
+    if inst_opts and inst_opts['async']:
+        return _pkg_inst_async(url, session, package, inst_opts, installs)
+    int_pkg_name = package['name']
+    started = time.time()
+    try:
+        install_status = _pkg_response(session.post(
+            url + '/crx/packmgr/service.jsp?cmd=inst&name=' + int_pkg_name,
+            timeout=_no_read_timeout(session, url), stream=True))
+    except requests.exceptions.RequestException as e:
+        # AEM may still be installing the package, it is left in place
+        if installs is not None:
+            installs.append({'name': int_pkg_name,
+                             'seconds': round(time.time() - started, 3),
+                             'log': [str(e)]})
+        print(str(e))
+        return False
+    if installs is not None:
+        installs.append({'name': int_pkg_name,
+                         'seconds': round(time.time() - started, 3)})
+    # if failure aem send status code 500 with responce status 200
+    if install_status.ok:
+        print('ok')
+        return True
+    else:
+        if installs is not None:
+            installs[-1]['log'] = install_status.message().splitlines()
+        print(install_status.message())
+        _pkg_remove(url, session, int_pkg_name)
+        return False
+
 
+def _pkg_install(url, session, file_name, file_path, install=False,
+                 strict=True, uploads=None, transfer=None, inst_opts=None,
+                 installs=None):
+    package = _pkg_upload_only(url, session, file_name, file_path, install,
+                               strict, uploads, transfer)
+    if package is None:
+        return None
+    print("testing result")
+    if _pkg_inst(url, session, package, inst_opts, installs):
+        return package
+    return None
 
-def _pkg_remove(url, login, password, int_pkg_name):
-    response = requests.post(url + '/crx/packmgr/service.jsp?cmd=rm&name=' + int_pkg_name, auth=(login, password))
-    aem_response = ET.fromstring(response.text)
+
+def _pkg_remove(url, session, int_pkg_name):
+    response = _pkg_response(session.post(
+        url + '/crx/packmgr/service.jsp?cmd=rm&name=' + int_pkg_name,
+        stream=True))
 
     # if failure aem send status code 500 with responce status 200
-    if (aem_response.find("response/status").attrib['code']) == '200':
+    if response.ok:
         print('ok')
         return True
     else:
@@ -142,18 +1086,450 @@ def _pkg_remove(url, login, password, int_pkg_name):
         return False
 
 
+def _pkg_select(index, name, group=None, version=None):
+    # a package matching name (and version), the group decides between
+    # several packages with the same name
+    candidates = [package for package in index['name'].get(name, [])
+                  if not version or package.get('version') == version]
+    if len(candidates) > 1:
+        candidates = [package for package in candidates
+                      if package.get('group') == group] or candidates
+    if len(candidates) == 1:
+        return candidates[0]
+    return None
+
+
+def _pkg_build(url, session, package):
+    # None when the package was built, otherwise the error of AEM
+    query = '?cmd=build&name=' + package['name']
+    if package.get('group'):
+        query += '&group=' + package['group']
+    try:
+        response = _pkg_response(session.post(
+            url + '/crx/packmgr/service.jsp' + query,
+            timeout=_no_read_timeout(session, url), stream=True))
+    except requests.exceptions.RequestException as e:
+        return str(e)
+    if response.ok:
+        return None
+    return response.message()
+
+
+def _pkg_download(url, session, package, dest, expected_sha256=None):
+    # the zip is written to a .part file chunk by chunk while it is hashed,
+    # and moved to dest only after size and hash were verified
+    started = time.time()
+    try:
+        response = session.get(url + _pkg_node_path(package), stream=True)
+    except requests.exceptions.RequestException as e:
+        return None, str(e)
+    if response.status_code != 200:
+        response.close()
+        return None, 'download returned HTTP %s' % response.status_code
+    tmp_path = dest + '.part'
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as package_file:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                package_file.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+    except (requests.exceptions.RequestException, IOError, OSError) as e:
+        # no partial multi-GB file is left behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None, 'connection lost after %s bytes: %s' % (size, e)
+    finally:
+        response.close()
+
+    error = None
+    expected_size = response.headers.get('Content-Length')
+    if expected_size and not response.headers.get('Content-Encoding') and \
+            int(expected_size) != size:
+        error = 'received %s of %s bytes' % (size, expected_size)
+    elif expected_sha256 and expected_sha256.lower() != sha256.hexdigest():
+        error = 'sha256 %s does not match %s' % (sha256.hexdigest(),
+                                                 expected_sha256)
+    if error:
+        os.remove(tmp_path)
+        return None, error
+    os.rename(tmp_path, dest)
+    stats = _upload_stats(package['downloadName'], size,
+                          time.time() - started)
+    stats['sha256'] = sha256.hexdigest()
+    return stats, None
+
+
+def _pkg_pull(module, url, session, specs, build, force, concurrency,
+              cache):
+    index = _pkg_list_index(url, session, cache)
+    results = []
+    for spec in specs:
+        if not spec.get('name') or not spec.get('path'):
+            module.fail_json(msg="every package to download needs name and "
+                             "path")
+        package = _pkg_select(index, spec['name'], spec.get('group'),
+                              spec.get('version'))
+        if package is None:
+            module.fail_json(msg="package %s not found or ambiguous, set "
+                             "group and version" % spec['name'])
+        dest = spec['path']
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, package['downloadName'])
+        results.append({'name': spec['name'], 'path': dest,
+                        'checksum': spec.get('checksum'), 'package': package,
+                        'status': 'pending'})
+
+    def pull(result):
+        if os.path.exists(result['path']) and not force:
+            result['status'] = 'skipped'
+            return
+        error = build and _pkg_build(url, session, result['package'])
+        if error:
+            result['status'] = 'build failed'
+            result['msg'] = error
+            return
+        stats, error = _pkg_download(url, session, result['package'],
+                                     result['path'], result['checksum'])
+        if error:
+            result['status'] = 'download failed: ' + error
+        else:
+            result['status'] = 'downloaded'
+            stats.pop('name')
+            result.update(stats)
+
+    pool = ThreadPool(max(1, min(concurrency, len(results))))
+    try:
+        pool.map(pull, results)
+    finally:
+        pool.close()
+        pool.join()
+    return _pkg_results(results)
+
+
+def _pkg_date(value):
+    # listing dates look like 'Mon, 30 Mar 2020 12:30:00 +0200'
+    parsed = value and email.utils.parsedate_tz(value)
+    if not parsed:
+        return 0
+    return email.utils.mktime_tz(parsed)
+
+
+def _pkg_prune_candidates(packages, keep, older_than, pattern=None,
+                          groups=None):
+    # per group/name the newest keep versions and the version installed
+    # last stay, the others go if they are older than older_than days
+    by_package = {}
+    for package in packages:
+        group = package.get('group') or ''
+        if groups and group not in groups:
+            continue
+        if group not in (groups or []) and \
+                group.split('/')[0] in PROTECTED_GROUPS:
+            continue
+        if pattern and not re.search(pattern,
+                                     package.get('downloadName') or ''):
+            continue
+        key = (package.get('group'), package.get('name'))
+        by_package.setdefault(key, []).append(package)
+
+    def created(package):
+        return _pkg_date(package.get('created') or package.get('lastModified'))
+
+    cutoff = time.time() - older_than * 86400
+    candidates = []
+    for versions in by_package.values():
+        versions.sort(key=created, reverse=True)
+        installed = max(versions, key=lambda package: _pkg_date(
+            package.get('lastUnpacked')))
+        for package in versions[keep:]:
+            if package is installed and package.get('lastUnpacked'):
+                continue
+            if older_than and created(package) > cutoff:
+                continue
+            candidates.append(package)
+    return candidates
+
+
+def _pkg_delete(url, session, package):
+    # deletes exactly this version, cmd=rm only takes a package name
+    response = session.post('%s/crx/packmgr/service/.json%s?cmd=delete'
+                            % (url, _pkg_node_path(package)))
+    try:
+        return response.status_code == 200 and response.json()['success']
+    except (ValueError, KeyError):
+        return False
+
+
+def _pkg_prune(url, session, keep, older_than, pattern, groups,
+               concurrency, cache):
+    packages = _pkg_list(url, session, cache)
+    candidates = _pkg_prune_candidates(packages, keep, older_than, pattern,
+                                       groups)
+    results = [{'group': package.get('group'), 'name': package.get('name'),
+                'version': package.get('version'),
+                'size': int(package.get('size') or 0),
+                'package': package} for package in candidates]
+
+    def delete(result):
+        result['removed'] = _pkg_delete(url, session, result['package'])
+
+    if results:
+        pool = ThreadPool(max(1, min(concurrency, len(results))))
+        try:
+            pool.map(delete, results)
+        finally:
+            pool.close()
+            pool.join()
+        _pkg_list_invalidate(url, cache)
+    return _pkg_results(results)
+
+
+def _pkg_order(module, packages):
+    # declared order, except that a package is moved behind the packages
+    # listed in its 'after' key
+    by_name = dict((package['name'], package) for package in packages)
+    ordered = []
+    done = set()
+    visiting = set()
+
+    def visit(package):
+        if package['name'] in done:
+            return
+        if package['name'] in visiting:
+            module.fail_json(msg="circular dependency on package %s"
+                             % package['name'])
+        visiting.add(package['name'])
+        for name in package.get('after') or []:
+            if name not in by_name:
+                module.fail_json(msg="package %s depends on unknown package "
+                                 "%s" % (package['name'], name))
+            visit(by_name[name])
+        visiting.discard(package['name'])
+        done.add(package['name'])
+        ordered.append(package)
+
+    for package in packages:
+        visit(package)
+    return ordered
+
+
+def _pkg_bulk_deploy(module, url, session, packages, force, validate,
+                     concurrency, cache, uploads, transfer=None,
+                     inst_opts=None):
+    for package in packages:
+        if not package.get('name') or not package.get('path'):
+            module.fail_json(msg="every item of packages needs name and path")
+
+    index = _pkg_list_index(url, session, cache)
+    results = []
+    for package in _pkg_order(module, packages):
+        identity = _pkg_properties(package['path'])
+        if identity:
+            exists = _pkg_find(index, identity['group'], identity['name'],
+                               identity['version']) is not None
+        else:
+            exists = package['name'] in index['name'] or \
+                package['name'] in index['downloadName']
+        skipped = exists and not (force or package.get('force'))
+        results.append({'name': package['name'], 'path': package['path'],
+                        'status': 'skipped' if skipped else 'pending',
+                        'upload_seconds': None, 'install_seconds': None})
+    pending = [result for result in results if result['status'] == 'pending']
+
+    def upload(result):
+        started = time.time()
+        result['package'] = _pkg_upload_only(url, session, result['name'],
+                                             result['path'], uploads=uploads,
+                                             transfer=transfer)
+        result['upload_seconds'] = round(time.time() - started, 3)
+        if result['package'] is None:
+            result['status'] = 'upload failed'
+
+    # uploads run in parallel, AEM installs packages one at a time
+    if pending:
+        pool = ThreadPool(max(1, min(concurrency, len(pending))))
+        try:
+            pool.map(upload, pending)
+        finally:
+            pool.close()
+            pool.join()
+        _pkg_list_invalidate(url, cache)
+
+    failed = [result['name'] for result in pending
+              if result['status'] == 'upload failed']
+    if failed:
+        module.fail_json(msg="Uploading packages %s is failed"
+                         % ', '.join(failed), packages=_pkg_results(results),
+                         uploads=uploads)
+
+    for result in pending:
+        int_pkg_name = result['package']['name']
+        started = time.time()
+        if validate and not _pkg_validate_uploaded(url, session,
+                                                   int_pkg_name):
+            _pkg_remove(url, session, int_pkg_name)
+            result['status'] = 'validation failed'
+        elif _pkg_inst(url, session, result['package'], inst_opts):
+            result['status'] = 'installed'
+        else:
+            result['status'] = 'install failed'
+        result['install_seconds'] = round(time.time() - started, 3)
+        if result['status'] != 'installed':
+            module.fail_json(msg="Installation package %s is failed"
+                             % result['name'],
+                             packages=_pkg_results(results), uploads=uploads)
+
+    return _pkg_results(results)
+
+
+def _pkg_fleet_deploy(module, urls, session, pkg_name, pkg_path, identity,
+                      force, validate, concurrency, cache, uploads,
+                      transfer=None, inst_opts=None):
+    results = [{'url': url, 'status': 'pending', 'upload_seconds': None,
+                'install_seconds': None} for url in urls]
+
+    def check(result):
+        try:
+            if identity:
+                exists = _pkg_identity_exist(result['url'], session,
+                                             identity, cache)
+            else:
+                exists = _pgk_exist(result['url'], session, pkg_name, cache)
+        except requests.exceptions.RequestException as error:
+            result['msg'] = str(error)
+            result['status'] = 'unreachable'
+            return
+        if exists and not force:
+            result['status'] = 'skipped'
+
+    def upload(result, source=None):
+        started = time.time()
+        try:
+            result['package'] = _pkg_upload_only(
+                result['url'], session, pkg_name, pkg_path, uploads=uploads,
+                transfer=transfer if source is None else TRANSFER_DEFAULTS,
+                source=source)
+        except requests.exceptions.RequestException as error:
+            result['msg'] = str(error)
+            result['package'] = None
+        else:
+            # a retry that succeeded drops the error of the failed attempt
+            result.pop('msg', None)
+        result['upload_seconds'] = round(time.time() - started, 3)
+        result['status'] = 'uploaded' if result['package'] else \
+            'upload failed'
+
+    def install(result):
+        _pkg_list_invalidate(result['url'], cache)
+        if result['status'] != 'uploaded':
+            return
+        started = time.time()
+        int_pkg_name = result['package']['name']
+        if validate and not _pkg_validate_uploaded(result['url'], session,
+                                                   int_pkg_name):
+            _pkg_remove(result['url'], session, int_pkg_name)
+            result['status'] = 'validation failed'
+        elif _pkg_inst(result['url'], session, result['package'],
+                       inst_opts):
+            result['status'] = 'installed'
+        else:
+            result['status'] = 'install failed'
+        result['install_seconds'] = round(time.time() - started, 3)
+
+    pool = ThreadPool(max(1, min(concurrency, len(results))))
+    try:
+        pool.map(check, results)
+        pending = [result for result in results
+                   if result['status'] == 'pending']
+
+        # the package is read once per wave of up to concurrency nodes and
+        # streamed to all of them, chunked uploads can't share a stream
+        streamed = not (transfer and transfer['chunk_size'])
+        for start in range(0, len(pending), max(1, concurrency)):
+            wave = pending[start:start + max(1, concurrency)]
+            if not streamed:
+                pool.map(upload, wave)
+                continue
+            fanout = _FanOut(pkg_path, len(wave))
+            fanout.start()
+
+            def shared_upload(number):
+                try:
+                    upload(wave[number], fanout.source(number))
+                finally:
+                    fanout.close(number)
+            pool.map(shared_upload, range(len(wave)))
+
+            # nodes that dropped out of the shared stream get a retry of
+            # their own
+            retry = [result for result in wave
+                     if result['status'] == 'upload failed']
+            if retry and transfer and transfer['retries']:
+                pool.map(upload, retry)
+
+        pool.map(install, pending)
+    finally:
+        pool.close()
+        pool.join()
+    return _pkg_results(results)
+
+
+def _pkg_results(results):
+    return [dict((key, value) for key, value in result.items()
+                 if key != 'package') for result in results]
+
+
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            state=dict(default='present', choices=['present', 'absent']),
+            state=dict(default='present',
+                       choices=['present', 'absent', 'downloaded',
+                                'pruned']),
             pkg_name=dict(type='str'),
             pkg_path=dict(type='str'),
+            packages=dict(type='list'),
+            pkg_concurrency=dict(default=4, type='int'),
+            pkg_retries=dict(default=3, type='int'),
+            pkg_retry_backoff=dict(default=2, type='float'),
+            pkg_connect_timeout=dict(default=30, type='float'),
+            pkg_read_timeout=dict(default=0, type='float'),
+            pkg_chunk_size=dict(default=0, type='int'),
+            pkg_group=dict(default='my_packages', type='str'),
+            pkg_version=dict(type='str'),
+            pkg_build=dict(default='true', type='bool'),
+            pkg_checksum=dict(type='str'),
+            prune_keep=dict(default=3, type='int'),
+            prune_older_than=dict(default=0, type='int'),
+            prune_pattern=dict(type='str'),
+            prune_groups=dict(type='list'),
+            pkg_install_async=dict(default='false', type='bool'),
+            pkg_poll_interval=dict(default=10, type='int'),
+            pkg_install_timeout=dict(default=3600, type='int'),
             aem_user=dict(required=True, type='str'),
             aem_passwd=dict(required=True, type='str', no_log=True),
-            aem_url=dict(required=True, type='str'),
+            aem_url=dict(type='str'),
+            aem_urls=dict(type='list'),
             aem_force=dict(default='false', type='bool'),
-            pkg_validate=dict(default='false', type='bool')
+            pkg_validate=dict(default='false', type='bool'),
+            pkg_upload_once=dict(default='false', type='bool'),
+            pkg_checksum_skip=dict(default='false', type='bool'),
+            pkg_manifest=dict(
+                default='~/.ansible/aem_packmgr_manifest.json', type='path'),
+            pkg_identity_check=dict(default='true', type='bool'),
+            pkg_list_cache_ttl=dict(default=0, type='int'),
+            pkg_list_cache_dir=dict(default='~/.ansible/tmp/aem_packmgr',
+                                    type='path'),
+            aem_timings_file=dict(type='path')
         ),
+        required_one_of=[['aem_url', 'aem_urls']],
+        required_if=[['state', 'pruned', ['prune_pattern', 'prune_groups'],
+                      True]],
+        mutually_exclusive=[['packages', 'pkg_name'],
+                            ['packages', 'pkg_path'],
+                            ['aem_url', 'aem_urls'],
+                            ['aem_urls', 'packages']],
         supports_check_mode=False
     )
 
@@ -161,35 +1537,204 @@ def main():
     aem_user = module.params.get('aem_user')
     aem_passwd = module.params.get('aem_passwd')
     aem_url = module.params.get('aem_url')
+    aem_urls = module.params.get('aem_urls')
     aem_force = module.params.get('aem_force')
     pkg_validate = module.params.get('pkg_validate')
+    pkg_upload_once = module.params.get('pkg_upload_once')
     state_changed = False
     message = "no changes"
     pkg_name = module.params.get('pkg_name')
     pkg_path = module.params.get('pkg_path')
+    pkg_identity_check = module.params.get('pkg_identity_check')
+    pkg_checksum_skip = module.params.get('pkg_checksum_skip')
+    pkg_manifest = module.params.get('pkg_manifest')
+    cache = {'ttl': module.params.get('pkg_list_cache_ttl'),
+             'dir': module.params.get('pkg_list_cache_dir'),
+             'indexes': {}, 'lock': threading.Lock()}
+    packages = module.params.get('packages')
+    pkg_concurrency = module.params.get('pkg_concurrency')
+    uploads = []
+    manifest = None
+    sha256 = None
+    identity = None
+    transfer = {'retries': module.params.get('pkg_retries'),
+                'backoff': module.params.get('pkg_retry_backoff'),
+                'chunk_size': module.params.get('pkg_chunk_size') * 1024 * 1024,
+                'group': module.params.get('pkg_group')}
+    inst_opts = {'async': module.params.get('pkg_install_async'),
+                 'poll_interval': module.params.get('pkg_poll_interval'),
+                 'timeout': module.params.get('pkg_install_timeout')}
+    installs = []
+    timeout = (module.params.get('pkg_connect_timeout') or None,
+               module.params.get('pkg_read_timeout') or None)
+    session = _aem_session(aem_user, aem_passwd, max(1, pkg_concurrency),
+                           timeout, transfer['retries'], transfer['backoff'])
+    # every HTTP call, returned as timings and optionally logged to a file
+    timings = _Timings(module.params.get('aem_timings_file'))
+    session.hooks['response'].append(timings.hook)
 
-    if state in ['present'] and (
-            aem_force or not _pgk_exist(aem_url, aem_user, aem_passwd,
-                                        pkg_name)):
+    if aem_urls and state not in ['present']:
+        module.fail_json(msg="aem_urls can be used with state present only")
 
-        if pkg_validate and not _pkg_validate(aem_url, aem_user, aem_passwd,
-                                              pkg_name, pkg_path):
-            message = "validation of  package " + pkg_name + " is failed"
-            module.fail_json(msg=message)
+    if state in ['pruned']:
+        results = _pkg_prune(aem_url, session,
+                             module.params.get('prune_keep'),
+                             module.params.get('prune_older_than'),
+                             module.params.get('prune_pattern'),
+                             module.params.get('prune_groups'),
+                             pkg_concurrency, cache)
+        removed = [result for result in results if result['removed']]
+        reclaimed = sum(result['size'] for result in removed)
+        if removed:
+            message = "Removing %d packages was successful" % len(removed)
+        failed = ['%s:%s:%s' % (result['group'], result['name'],
+                                result['version'])
+                  for result in results if not result['removed']]
+        if failed:
+            module.fail_json(msg="Removing packages %s is failed"
+                             % ', '.join(failed), changed=bool(removed),
+                             packages=results, bytes_reclaimed=reclaimed)
+        module.exit_json(changed=bool(removed), msg=message,
+                         packages=results, bytes_reclaimed=reclaimed,
+                         timings=timings.summary())
+
+    if state in ['downloaded']:
+        if not packages:
+            if not pkg_name or not pkg_path:
+                module.fail_json(msg="pkg_name and pkg_path are required to "
+                                 "download a package")
+            packages = [{'name': pkg_name, 'path': pkg_path,
+                         'group': module.params.get('pkg_group'),
+                         'version': module.params.get('pkg_version'),
+                         'checksum': module.params.get('pkg_checksum')}]
+        results = _pkg_pull(module, aem_url, session, packages,
+                            module.params.get('pkg_build'), aem_force,
+                            pkg_concurrency, cache)
+        downloaded = [result['name'] for result in results
+                      if result['status'] == 'downloaded']
+        failed = [result['name'] for result in results
+                  if result['status'] not in ['downloaded', 'skipped']]
+        if failed:
+            module.fail_json(msg="Downloading packages %s is failed"
+                             % ', '.join(failed), packages=results)
+        if downloaded:
+            message = "Downloading packages " + ', '.join(downloaded) + \
+                " was successful"
+        module.exit_json(changed=bool(downloaded), msg=message,
+                         packages=results, timings=timings.summary())
+
+    if packages:
+        if state not in ['present']:
+            module.fail_json(msg="packages can be used with state present "
+                             "and downloaded only")
+        results = _pkg_bulk_deploy(module, aem_url, session, packages,
+                                   aem_force, pkg_validate, pkg_concurrency,
+                                   cache, uploads, transfer, inst_opts)
+        installed = [result['name'] for result in results
+                     if result['status'] == 'installed']
+        if installed:
+            message = "Installation packages " + ', '.join(installed) + \
+                " was successful"
+        module.exit_json(changed=bool(installed), msg=message,
+                         packages=results, uploads=uploads,
+                         timings=timings.summary())
+
+    if state in ['present'] and pkg_path and pkg_identity_check:
+        identity = _pkg_properties(pkg_path)
+        if identity and not pkg_name:
+            pkg_name = identity['name']
+    if state in ['present'] and not pkg_name:
+        module.fail_json(msg="pkg_name is required when the package name "
+                         "can't be read from pkg_path")
+
+    if aem_urls:
+        if not pkg_path:
+            module.fail_json(msg="pkg_path is required with aem_urls")
+        results = _pkg_fleet_deploy(module, aem_urls, session, pkg_name,
+                                    pkg_path, identity, aem_force,
+                                    pkg_validate, pkg_concurrency, cache,
+                                    uploads, transfer, inst_opts)
+        installed = [result['url'] for result in results
+                     if result['status'] == 'installed']
+        failed = [result['url'] for result in results
+                  if result['status'] not in ['installed', 'skipped']]
+        if failed:
+            module.fail_json(msg="Installation package %s is failed on %s"
+                             % (pkg_name, ', '.join(failed)),
+                             changed=bool(installed), nodes=results,
+                             package=identity, uploads=uploads)
+        if installed:
+            message = "Installation package " + pkg_name + \
+                " was successful on " + ', '.join(installed)
+        module.exit_json(changed=bool(installed), msg=message, nodes=results,
+                         package=identity, uploads=uploads,
+                         timings=timings.summary())
+
+    if state in ['present'] and pkg_checksum_skip:
+        manifest = _manifest_load(pkg_manifest)
+        sha256 = _pkg_checksum(manifest, pkg_path)
+        if _pkg_same_installed(aem_url, session, manifest, sha256, cache):
+            _manifest_save(pkg_manifest, manifest)
+            message = "package " + pkg_name + " with the same content " \
+                "is already installed"
+            module.exit_json(changed=False, msg=message, sha256=sha256,
+                             package=identity, uploads=uploads,
+                             timings=timings.summary())
 
-        if _pkg_install(aem_url, aem_user, aem_passwd, pkg_name, pkg_path):
+    if state in ['present'] and identity:
+        exists = _pkg_identity_exist(aem_url, session, identity, cache)
+    elif state in ['present']:
+        exists = _pgk_exist(aem_url, session, pkg_name, cache)
+
+    if state in ['present'] and (aem_force or not exists):
+
+        if pkg_validate and pkg_upload_once:
+            installed = _pkg_upload_only(aem_url, session, pkg_name, pkg_path,
+                                         uploads=uploads, transfer=transfer)
+            if installed is None:
+                message = "Uploading package " + pkg_name + " is failed"
+                module.fail_json(msg=message, uploads=uploads)
+
+            if not _pkg_validate_uploaded(aem_url, session,
+                                          installed['name']):
+                _pkg_remove(aem_url, session, installed['name'])
+                message = "validation of  package " + pkg_name + " is failed"
+                module.fail_json(msg=message, uploads=uploads)
+
+            if not _pkg_inst(aem_url, session, installed, inst_opts,
+                             installs):
+                installed = None
+        else:
+            if pkg_validate and not _pkg_validate(aem_url, session, pkg_name,
+                                                  pkg_path, uploads,
+                                                  transfer):
+                message = "validation of  package " + pkg_name + " is failed"
+                module.fail_json(msg=message, uploads=uploads)
+
+            installed = _pkg_install(aem_url, session, pkg_name, pkg_path,
+                                     uploads=uploads, transfer=transfer,
+                                     inst_opts=inst_opts, installs=installs)
+
+        _pkg_list_invalidate(aem_url, cache)
+        if installed:
 
             state_changed = True
             message = "Installation package " + pkg_name + " was successful"
+            if manifest is not None:
+                _pkg_record(aem_url, session, manifest, sha256, installed,
+                            cache)
+                _manifest_save(pkg_manifest, manifest)
         else:
 
             message = "Installation package " + pkg_name + " is failed"
-            module.fail_json(msg=message)
+            module.fail_json(msg=message, uploads=uploads, installs=installs)
 
-    if state in ['absent'] and _pgk_exist(aem_url, aem_user, aem_passwd,
-                                          pkg_name):
+    if state in ['absent'] and _pgk_exist(aem_url, session, pkg_name,
+                                          cache):
 
-        if _pkg_remove(aem_url, aem_user, aem_passwd, pkg_name):
+        removed = _pkg_remove(aem_url, session, pkg_name)
+        _pkg_list_invalidate(aem_url, cache)
+        if removed:
 
             state_changed = True
             message = "Removing package " + pkg_name + " was successful"
@@ -197,7 +1742,9 @@ def main():
             message = "Removing package " + pkg_name + " is failed"
             module.fail_json(msg=message)
 
-    module.exit_json(changed=state_changed, msg=message)
+    module.exit_json(changed=state_changed, msg=message, sha256=sha256,
+                     package=identity, uploads=uploads, installs=installs,
+                     timings=timings.summary())
 
 
 main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2019, Lean Delivery Team <team@lean-delivery.com>
+# GNU General Public License v3.0+ (see COPYING or
+# https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Runs aem_bundle against the fake Felix console and reports wall time,
+# tasks per second and console requests for single-bundle, batch and fleet
+# operations. Needs ansible and requests installed, like the module itself.
+#
+#   python benchmarks/bench_bundle.py
+#   python benchmarks/bench_bundle.py --bundles 1000 --latency 0.02 --nodes 8
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from ansible.module_utils.json_utils import _filter_non_json_lines
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_felix import FelixState, serve  # noqa: E402
+
+MODULE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'aem_bundle.py')
+
+
+def parse_result(stdout):
+    # the module result as Ansible reads it from stdout, None when Ansible
+    # could not parse it either
+    try:
+        data, _ = _filter_non_json_lines(stdout.decode('utf-8', 'replace'))
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def run_module(args):
+    with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                     delete=False) as args_file:
+        json.dump({'ANSIBLE_MODULE_ARGS': args}, args_file)
+    try:
+        process = subprocess.Popen([sys.executable, MODULE, args_file.name],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, _ = process.communicate()
+    finally:
+        os.remove(args_file.name)
+    return parse_result(stdout)
+
+
+def stop_all(state, count):
+    # puts bundles 1 to count in Resolved, so start has work to do. The
+    # system bundle 0 is never stopped
+    for bundle in state.bundles[1:count + 1]:
+        state.set_state(bundle, 'Resolved')
+
+
+def scenario(name, nodes, tasks, concurrency=1):
+    # tasks are (node index, module args), run in up to concurrency
+    # processes at a time like ansible forks
+    for state, _ in nodes:
+        state.reset()
+    started = time.time()
+
+    def run(task):
+        state, url = nodes[task[0]]
+        return run_module(dict(task[1], url=url, admin_user='admin',
+                               admin_password='admin'))
+    pool = ThreadPool(concurrency)
+    try:
+        results = pool.map(run, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+    return {'scenario': name, 'tasks': len(tasks),
+            'seconds': round(elapsed, 3),
+            'tasks_per_sec': round(len(tasks) / elapsed, 2),
+            'requests': sum(state.stats()['total'] for state, _ in nodes),
+            'failed': any(not result or result.get('failed')
+                          for result in results)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='aem_bundle benchmarks against a fake Felix console')
+    parser.add_argument('--bundles', type=int, default=500,
+                        help='bundles in every fake framework (up to 1000)')
+    parser.add_argument('--batch', type=int, default=60,
+                        help='bundles handled by one batch task')
+    parser.add_argument('--tasks', type=int, default=20,
+                        help='tasks in the single-bundle scenario')
+    parser.add_argument('--nodes', type=int, default=4,
+                        help='fake nodes in the fleet scenario')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON lines')
+    options = parser.parse_args()
+
+    nodes = []
+    for _ in range(max(1, options.nodes)):
+        state = FelixState(options.bundles, options.latency)
+        server = serve(state)
+        nodes.append((state, 'http://127.0.0.1:%d'
+                      % server.server_address[1]))
+    state = nodes[0][0]
+    names = ['com.example.bench.b%d' % number
+             for number in range(1, min(options.batch, options.bundles) + 1)]
+    results = []
+
+    stop_all(state, options.tasks)
+    results.append(scenario('single-start', nodes[:1], [
+        (0, {'name': 'com.example.bench.b%d' % (number + 1),
+             'action': 'start'}) for number in range(options.tasks)]))
+
+    stop_all(state, len(names))
+    results.append(scenario('batch-start-%d' % len(names), nodes[:1], [
+        (0, {'names': names, 'action': 'start', 'concurrency': 8})]))
+
+    results.append(scenario('batch-refresh-ordered-%d' % len(names),
+                            nodes[:1], [
+        (0, {'names': names, 'action': 'refresh', 'ordered': True,
+             'concurrency': 8})]))
+
+    results.append(scenario('all-active', nodes[:1], [
+        (0, {'state': 'all_active', 'wait_timeout': 60})]))
+
+    for fleet_state, _ in nodes:
+        stop_all(fleet_state, len(names))
+    results.append(scenario('fleet-start-%dx%d' % (len(nodes), len(names)),
+                            nodes, [
+        (node, {'names': names, 'action': 'start', 'concurrency': 8})
+        for node in range(len(nodes))], concurrency=len(nodes)))
+
+    for result in results:
+        if options.json:
+            print(json.dumps(result))
+        else:
+            print('%-28s %4d tasks %9.3fs %8.2f tasks/s %7d requests%s' % (
+                result['scenario'], result['tasks'], result['seconds'],
+                result['tasks_per_sec'], result['requests'],
+                ' FAILED' if result['failed'] else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2019, Lean Delivery Team <team@lean-delivery.com>
+# GNU General Public License v3.0+ (see COPYING or
+# https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Runs aem_packmgr against the fake package manager and reports wall time,
+# peak RSS of the module process and bytes transferred per scenario.
+# Needs ansible and requests installed, like the module itself.
+#
+#   python benchmarks/bench_packmgr.py
+#   python benchmarks/bench_packmgr.py --sizes 10M,1G --bandwidth 50M
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from ansible.module_utils.json_utils import _filter_non_json_lines
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_packmgr import PackMgrState, serve  # noqa: E402
+
+MODULE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'aem_packmgr.py')
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_size(value):
+    value = value.strip().upper()
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def make_package(directory, name, size):
+    # a vault package with a single stored entry of the requested size
+    path = os.path.join(directory, '%s.zip' % name)
+    if os.path.exists(path):
+        return path
+    block = os.urandom(WRITE_CHUNK_SIZE)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED,
+                         allowZip64=True) as archive:
+        archive.writestr(
+            'META-INF/vault/properties.xml',
+            '<?xml version="1.0" encoding="UTF-8"?><properties>'
+            '<entry key="group">bench</entry>'
+            '<entry key="name">%s</entry>'
+            '<entry key="version">1.0</entry></properties>' % name)
+        archive.writestr(
+            'META-INF/vault/filter.xml',
+            '<?xml version="1.0" encoding="UTF-8"?><workspaceFilter '
+            'version="1.0"><filter root="/content/bench"/></workspaceFilter>')
+        with archive.open('jcr_root/content/bench/data.bin', 'w',
+                          force_zip64=True) as entry:
+            written = 0
+            while written < size:
+                chunk = block[:min(WRITE_CHUNK_SIZE, size - written)]
+                entry.write(chunk)
+                written += len(chunk)
+    return path
+
+
+def parse_result(stdout):
+    # the module result as Ansible reads it from stdout, None when Ansible
+    # could not parse it either
+    try:
+        data, _ = _filter_non_json_lines(stdout.decode('utf-8', 'replace'))
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def run_module(args):
+    # one module process per run, wait4 gives the rusage of just that child
+    with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                     delete=False) as args_file:
+        json.dump({'ANSIBLE_MODULE_ARGS': args}, args_file)
+    try:
+        started = time.time()
+        process = subprocess.Popen([sys.executable, MODULE, args_file.name],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout = process.stdout.read()
+        process.stderr.read()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = status
+        elapsed = time.time() - started
+    finally:
+        os.remove(args_file.name)
+    result = parse_result(stdout)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return elapsed, rss, result
+
+
+def scenario(name, state, url, args):
+    state.reset()
+    elapsed, rss, result = run_module(dict(args, aem_url=url,
+                                           aem_user='admin',
+                                           aem_passwd='admin'))
+    stats = state.stats()
+    return {'scenario': name, 'seconds': round(elapsed, 3),
+            'peak_rss_mb': round(rss / 1024.0 / 1024, 1),
+            'bytes_in': stats['bytes_in'], 'bytes_out': stats['bytes_out'],
+            'requests': stats['requests'],
+            'failed': not result or bool(result.get('failed'))}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='aem_packmgr benchmarks against a fake package manager')
+    parser.add_argument('--sizes', default='10M,1G,5G',
+                        help='package sizes to upload and install')
+    parser.add_argument('--listing', type=int, default=1000,
+                        help='packages in the listing scenario')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    parser.add_argument('--bandwidth', default='0',
+                        help='bytes per second (e.g. 100M), 0 for unlimited')
+    parser.add_argument('--workdir', default=tempfile.gettempdir(),
+                        help='where the generated packages are kept')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON lines')
+    options = parser.parse_args()
+
+    state = PackMgrState(options.listing, options.latency,
+                         parse_size(options.bandwidth))
+    server = serve(state)
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    results = []
+
+    results.append(scenario('listing-%d' % options.listing, state, url, {
+        'state': 'present', 'pkg_name': 'package-0',
+        'pkg_path': MODULE, 'pkg_identity_check': False}))
+
+    for size in options.sizes.split(','):
+        name = 'bench-%s' % size.strip().lower()
+        path = make_package(options.workdir, name, parse_size(size))
+        results.append(scenario('install-%s' % size.strip(), state, url, {
+            'state': 'present', 'pkg_path': path, 'aem_force': True}))
+        with state.lock:
+            state.packages.pop(name, None)
+
+    server.shutdown()
+    for result in results:
+        if options.json:
+            print(json.dumps(result))
+        else:
+            print('%-16s %9.3fs %8.1f MB RSS %14d B in %10d B out%s' % (
+                result['scenario'], result['seconds'], result['peak_rss_mb'],
+                result['bytes_in'], result['bytes_out'],
+                ' FAILED' if result['failed'] else ''))
+
+
+if __name__ == '__main__':
+    main()
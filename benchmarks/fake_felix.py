@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2019, Lean Delivery Team <team@lean-delivery.com>
+# GNU General Public License v3.0+ (see COPYING or
+# https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Local stand-in for the Felix web console bundle endpoints, good enough to
+# drive aem_bundle in benchmarks: /system/console/bundles.json, the bundle
+# details in /system/console/bundles/<id or name>.json and the POST action
+# on /system/console/bundles/<id or name>.
+
+import argparse
+import json
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+STATE_RAW = {'Installed': 2, 'Resolved': 4, 'Fragment': 4, 'Active': 32}
+# every FRAGMENT_EVERY-th bundle is a fragment, every IMPORT_EVERY-th one
+# imports a package from the bundle before it
+FRAGMENT_EVERY = 50
+IMPORT_EVERY = 3
+
+
+class FelixState(object):
+    """bundles known to the fake console and request counters"""
+
+    def __init__(self, bundles=0, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bundles = []
+        for number in range(bundles):
+            fragment = number and number % FRAGMENT_EVERY == 0
+            self.bundles.append({
+                'id': number, 'name': 'Bench bundle %d' % number,
+                'symbolicName': 'com.example.bench.b%d' % number,
+                'version': '1.0.%d' % number, 'category': 'bench',
+                'fragment': bool(fragment),
+                'state': 'Fragment' if fragment else 'Active',
+                'stateRaw': STATE_RAW['Active']})
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def find(self, key):
+        with self.lock:
+            for bundle in self.bundles:
+                if key in [str(bundle['id']), bundle['symbolicName']]:
+                    return bundle
+        return None
+
+    def set_state(self, bundle, state):
+        with self.lock:
+            if not bundle['fragment']:
+                bundle['state'] = state
+                bundle['stateRaw'] = STATE_RAW[state]
+
+    def counters(self):
+        # the s array of bundles.json: total, active, fragment, resolved,
+        # installed
+        with self.lock:
+            states = [bundle['state'] for bundle in self.bundles]
+        return [len(states), states.count('Active'), states.count('Fragment'),
+                states.count('Resolved'), states.count('Installed')]
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests),
+                    'total': sum(self.requests.values())}
+
+
+def _details(bundle):
+    props = [{'key': 'Exported Packages',
+              'value': ['com.example.bench.p%d,version=1.0.0' % bundle['id']]}]
+    if bundle['id'] and bundle['id'] % IMPORT_EVERY == 0:
+        provider = bundle['id'] - 1
+        props.append({'key': 'Imported Packages', 'value': [
+            "com.example.bench.p%d,version=[1.0,2) from <a href='/system/"
+            "console/bundles/%d'>com.example.bench.b%d (%d)</a>"
+            % (provider, provider, provider, provider)]})
+    else:
+        props.append({'key': 'Imported Packages', 'value': 'None'})
+    return dict(bundle, props=props)
+
+
+class FelixHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, kind, data, code=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.state.count(kind)
+
+    def _status(self, data):
+        counters = self.state.counters()
+        return {'status': 'Bundle information: %d bundles in total.'
+                % counters[0], 's': counters, 'data': data}
+
+    def do_GET(self):
+        time.sleep(self.state.latency)
+        path = urlparse(self.path).path
+        if path == '/system/console/bundles.json':
+            with self.state.lock:
+                data = [dict(bundle) for bundle in self.state.bundles]
+            return self._reply('list', self._status(data))
+        if path.startswith('/system/console/bundles/') and \
+                path.endswith('.json'):
+            bundle = self.state.find(path.split('/')[-1][:-len('.json')])
+            if bundle is None:
+                return self._reply('details', {}, 404)
+            return self._reply('details', self._status([_details(bundle)]))
+        self._reply('unknown', {}, 404)
+
+    def do_POST(self):
+        time.sleep(self.state.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        action = (form.get('action') or [''])[0]
+        path = urlparse(self.path).path
+        bundle = None
+        if path.startswith('/system/console/bundles/'):
+            bundle = self.state.find(path.split('/')[-1])
+        if bundle is None or action not in ['start', 'stop', 'refresh']:
+            return self._reply(action or 'unknown', {}, 404)
+        if action == 'start':
+            self.state.set_state(bundle, 'Active')
+        elif action == 'stop':
+            self.state.set_state(bundle, 'Resolved')
+        self._reply(action, {'fragment': bundle['fragment'],
+                             'stateRaw': bundle['stateRaw']})
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(state, host='127.0.0.1', port=0):
+    handler = type('Handler', (FelixHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='fake Felix web console for benchmarks')
+    parser.add_argument('--port', type=int, default=4502)
+    parser.add_argument('--bundles', type=int, default=500,
+                        help='bundles in the framework')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    args = parser.parse_args()
+    server = serve(FelixState(args.bundles, args.latency), port=args.port)
+    print('fake Felix console listening on http://127.0.0.1:%d'
+          % server.server_address[1])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
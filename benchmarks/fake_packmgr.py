@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2019, Lean Delivery Team <team@lean-delivery.com>
+# GNU General Public License v3.0+ (see COPYING or
+# https://www.gnu.org/licenses/gpl-3.0.txt)
+
+# Local stand-in for the AEM package manager (/crx/packmgr/service.jsp),
+# good enough to drive aem_packmgr in benchmarks. Uploads are read and
+# discarded chunk by chunk, so multi-GB packages don't need memory here.
+
+import argparse
+import json
+import re
+import threading
+import time
+from datetime import datetime
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+READ_CHUNK_SIZE = 256 * 1024
+
+
+class PackMgrState(object):
+    """packages known to the fake server and transfer counters"""
+
+    def __init__(self, packages=0, latency=0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.packages = {}
+        for number in range(packages):
+            self.add('bench', 'package-%d' % number, '1.0.%d' % number,
+                     installed=True)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.requests = {}
+
+    def count(self, cmd, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.requests[cmd] = self.requests.get(cmd, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def add(self, group, name, version, installed=False, size=0):
+        now = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S +0000')
+        with self.lock:
+            self.packages[name] = {
+                'group': group, 'name': name, 'version': version,
+                'downloadName': '%s-%s.zip' % (name, version),
+                'size': str(size), 'created': now, 'lastModified': now,
+                'lastUnpacked': now if installed else ''}
+            return self.packages[name]
+
+    def stats(self):
+        with self.lock:
+            return {'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'requests': dict(self.requests)}
+
+
+def _xml(data='', code=200, text='ok'):
+    return ('<?xml version="1.0" encoding="utf-8"?><crx version="1.0">'
+            '<request/><response><data>%s</data><status code="%d">%s'
+            '</status></response></crx>' % (data, code, text)).encode('utf-8')
+
+
+def _package_xml(package):
+    return '<package>%s</package>' % ''.join(
+        '<%s>%s</%s>' % (key, value, key) for key, value in package.items())
+
+
+class PackMgrHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def _throttle(self, size, started):
+        # sleep until size bytes took at least size / bandwidth seconds
+        if self.state.bandwidth:
+            delay = float(size) / self.state.bandwidth - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _reply(self, cmd, body, code=200, content_type='text/xml',
+               bytes_in=0):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        started = time.time()
+        self.wfile.write(body)
+        self._throttle(len(body), started)
+        self.state.count(cmd, bytes_in, len(body))
+
+    def _send_zeros(self, size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        block = b'\0' * READ_CHUNK_SIZE
+        sent = 0
+        started = time.time()
+        while sent < size:
+            chunk = block[:min(READ_CHUNK_SIZE, size - sent)]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            self._throttle(sent, started)
+        self.state.count('download', 0, size)
+
+    def _read_body(self):
+        # returns (bytes read, first chunk) without keeping the whole body
+        remaining = int(self.headers.get('Content-Length') or 0)
+        size = 0
+        head = b''
+        started = time.time()
+        while remaining > 0:
+            chunk = self.rfile.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if not head:
+                head = chunk
+            size += len(chunk)
+            remaining -= len(chunk)
+            self._throttle(size, started)
+        return size, head
+
+    def do_GET(self):
+        time.sleep(self.state.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/crx/packmgr/service.jsp' and \
+                query.get('cmd') == ['ls']:
+            with self.state.lock:
+                packages = ''.join(_package_xml(package) for package in
+                                   self.state.packages.values())
+            return self._reply('ls', _xml('<packages>%s</packages>'
+                                          % packages))
+        if url.path == '/crx/packmgr/installstatus.jsp':
+            body = json.dumps({'status': {'finished': True, 'itemCount': 0}})
+            return self._reply('installstatus', body.encode('utf-8'),
+                               content_type='application/json')
+        if url.path.endswith('/jcr:content/vlt:definition.json'):
+            package = self._by_download_name(url.path.split('/')[-3])
+            if package is None:
+                return self._reply('definition', b'{}', 404)
+            body = json.dumps({'lastUnpacked': package['lastUnpacked']})
+            return self._reply('definition', body.encode('utf-8'),
+                               content_type='application/json')
+        if url.path.startswith('/etc/packages/'):
+            package = self._by_download_name(url.path.split('/')[-1])
+            if package is None:
+                return self._reply('download', b'', 404)
+            return self._send_zeros(int(package['size']))
+        self._reply('unknown', b'', 404)
+
+    def do_POST(self):
+        time.sleep(self.state.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        cmd = (query.get('cmd') or ['upload'])[0]
+        size, head = self._read_body()
+        name = (query.get('name') or [None])[0]
+
+        if url.path.startswith('/crx/packmgr/service/.json/'):
+            package = self._by_download_name(url.path.split('/')[-1])
+            if package is not None and cmd == 'delete':
+                with self.state.lock:
+                    self.state.packages.pop(package['name'], None)
+            body = json.dumps({'success': package is not None, 'msg': cmd})
+            return self._reply(cmd, body.encode('utf-8'),
+                               content_type='application/json',
+                               bytes_in=size)
+
+        if cmd in ['upload', 'validate'] and size:
+            match = re.search(b'filename="([^"]+)"', head)
+            file_name = match.group(1).decode('utf-8') if match else 'upload'
+            if cmd == 'validate':
+                return self._reply(cmd, _xml(), bytes_in=size)
+            package = self.state.add('bench', file_name, '1.0', size=size)
+            return self._reply(cmd, _xml(_package_xml(package)),
+                               bytes_in=size)
+
+        with self.state.lock:
+            package = self.state.packages.get(name)
+        if package is None:
+            return self._reply(cmd, _xml(code=500, text='no package'),
+                               bytes_in=size)
+        if cmd == 'inst':
+            package['lastUnpacked'] = datetime.utcnow().strftime(
+                '%a, %d %b %Y %H:%M:%S +0000')
+            log = ''.join('A /content/bench/node-%d\n' % number
+                          for number in range(1000))
+            return self._reply(cmd, _xml('<log>%s</log>' % log),
+                               bytes_in=size)
+        if cmd == 'rm':
+            with self.state.lock:
+                self.state.packages.pop(name, None)
+        self._reply(cmd, _xml(), bytes_in=size)
+
+    def _by_download_name(self, download_name):
+        with self.state.lock:
+            for package in self.state.packages.values():
+                if package['downloadName'] == download_name:
+                    return package
+        return None
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(state, host='127.0.0.1', port=0):
+    handler = type('Handler', (PackMgrHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='fake AEM package manager for benchmarks')
+    parser.add_argument('--port', type=int, default=4502)
+    parser.add_argument('--packages', type=int, default=0,
+                        help='packages in the initial listing')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='bytes per second, 0 for unlimited')
+    args = parser.parse_args()
+    server = serve(PackMgrState(args.packages, args.latency, args.bandwidth),
+                   port=args.port)
+    print('fake packmgr listening on http://127.0.0.1:%d'
+          % server.server_address[1])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()